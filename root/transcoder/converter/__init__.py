@@ -2,9 +2,10 @@
 
 import os
 
-from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list, attachment_codec_list
+from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list, attachment_codec_list, VideoCodec
 from converter.formats import format_list
-from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError
+from converter.filtergraph import Filter, FilterGraph
+from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError, ProgressEvent, ProbeCache, Capabilities
 
 
 class ConverterError(Exception):
@@ -18,13 +19,16 @@ class Converter(object):
     >>> c = Converter()
     """
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, cache=None, capabilities_file=None):
         """
-        Initialize a new Converter object.
+        Initialize a new Converter object, optionally reusing probe results
+        from a ProbeCache and persisting ffmpeg capabilities to a file.
         """
 
         self.ffmpeg = FFMpeg(ffmpeg_path=ffmpeg_path,
-                             ffprobe_path=ffprobe_path)
+                             ffprobe_path=ffprobe_path,
+                             cache=cache,
+                             capabilities_file=capabilities_file)
         self.video_codecs = {}
         self.audio_codecs = {}
         self.subtitle_codecs = {}
@@ -62,9 +66,11 @@ class Converter(object):
             return next((x.codec_name for x in attachment_codec_list if x.ffmpeg_codec_name == ffmpeg_codec_name), None)
         return None
 
-    def parse_options(self, opt, twopass=None, strip_metadata=False):
+    def parse_options(self, opt, twopass=None, strip_metadata=False, graph=None):
         """
         Parse format/codec options and prepare raw ffmpeg option list.
+        Video filters are added to graph when one is given, instead of
+        being returned as a -vf option.
         """
         format_options = None
         audio_options = []
@@ -95,13 +101,15 @@ class Converter(object):
             if isinstance(y, str):
                 y = [y]
 
-            for x in y:
+            for sindex, x in enumerate(y):
                 if not os.path.exists(x):
                     raise ConverterError('Source file does not exist')
                 if 'sub-encoding' in opt:
-                    sindex = opt['source'].index(x)
-                    if len([x for x in opt.get('subtitle', []) if x.get('source') == sindex]) > 0:
+                    if len([s for s in opt.get('subtitle', []) if s.get('source') == sindex]) > 0:
                         source_options.extend(['-sub_charenc', opt['sub-encoding']])
+                # Shift the timestamps of a source, for intermediates whose streams started later than the original
+                if opt.get('source-offsets', {}).get(sindex):
+                    source_options.extend(['-itsoffset', '%.6f' % opt['source-offsets'][sindex]])
                 source_options.extend(['-i', x])
 
         # Audio
@@ -179,7 +187,8 @@ class Converter(object):
             if c not in self.video_codecs:
                 raise ConverterError('Requested unknown video codec ' + str(c))
 
-            video_options = self.video_codecs[c]().parse_options(x)
+            codec = self.video_codecs[c]()
+            video_options = codec.parse_options(x, graph=graph) if isinstance(codec, VideoCodec) else codec.parse_options(x)
             if video_options is None:
                 raise ConverterError('Unknown video codec error')
 
@@ -225,8 +234,16 @@ class Converter(object):
         for timecode, debug in self.ffmpeg.convert(outfile, opts):
             yield int((100.0 * timecode) / info.format.duration), debug
         os.remove(infile)
+        self.invalidate(outfile)
+
+    def invalidate(self, fname):
+        """
+        Forget cached probe results for a file that has been rewritten.
+        """
+        if self.ffmpeg.cache:
+            self.ffmpeg.cache.invalidate(fname)
 
-    def convert(self, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, strip_metadata=False):
+    def convert(self, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, strip_metadata=False, info=None, logfile=None):
         """
         Convert media file (infile) according to specified options, and
         save it to outfile. For two-pass encoding, specify the pass (1 or 2)
@@ -240,6 +257,8 @@ class Converter(object):
             * video (optional, dict) - video codec and options; see
               avcodecs.VideoCodec for list of supported options
             * map (optional, int) - can be used to map all content of stream 0
+            * source-offsets (optional, dict) - seconds to shift the
+              timestamps of a source by, keyed by its index in source
 
         Multiple audio/video streams are not supported. The output has to
         have at least an audio or a video stream (or both).
@@ -259,6 +278,12 @@ class Converter(object):
         timeout is handled (using signals) has special restriction when
         using threads.
 
+        A MediaInfo object already probed from the source may be passed as
+        info to avoid probing the source again.
+
+        Only the tail of the ffmpeg output is held in memory, pass a path
+        as logfile to have the full output written there.
+
         >>> conv = Converter().convert('test1.ogg', '/tmp/output.mkv', {
         ...    'format': 'mkv',
         ...    'audio': { 'codec': 'aac' },
@@ -277,7 +302,7 @@ class Converter(object):
 
         infile = options['source'][0]
 
-        info = self.ffmpeg.probe(infile)
+        info = info or self.ffmpeg.probe(infile)
         if info is None:
             raise ConverterError("Can't get information about source file")
 
@@ -302,7 +327,8 @@ class Converter(object):
                                                        optlist1,
                                                        timeout=timeout,
                                                        preopts=preopts,
-                                                       postopts=postopts):
+                                                       postopts=postopts,
+                                                       logfile=logfile):
                 yield int((50.0 * timecode) / info.format.duration), debug
 
             optlist2 = self.parse_options(options, 2, strip_metadata=strip_metadata)
@@ -310,7 +336,8 @@ class Converter(object):
                                                        optlist2,
                                                        timeout=timeout,
                                                        preopts=preopts,
-                                                       postopts=postopts):
+                                                       postopts=postopts,
+                                                       logfile=logfile):
                 yield int(50.0 + (50.0 * timecode) / info.format.duration), debug
         else:
             optlist = self.parse_options(options, twopass, strip_metadata=strip_metadata)
@@ -318,9 +345,120 @@ class Converter(object):
                                                        optlist,
                                                        timeout=timeout,
                                                        preopts=preopts,
-                                                       postopts=postopts):
+                                                       postopts=postopts,
+                                                       logfile=logfile):
                 yield int((100.0 * timecode) / info.format.duration), debug
 
+    @staticmethod
+    def _split_source_options(optlist):
+        """
+        Separate the leading input options (-sub_charenc/-itsoffset/-i pairs)
+        produced by parse_options from the output options that follow them.
+        """
+        i = 0
+        while i < len(optlist) and optlist[i] in ['-i', '-sub_charenc', '-itsoffset']:
+            i += 2
+        return optlist[:i], optlist[i:]
+
+    def convert_ladder(self, outputs, timeout=10, preopts=None, strip_metadata=False, info=None, logfile=None):
+        """
+        Convert the source media into several outputs with a single ffmpeg
+        invocation. The video stream is decoded once and fanned out to each
+        output with a split filter; filters shared by every output (such as
+        deinterlacing) are applied once before the split.
+
+        Outputs should be passed as a list of (outfile, options, postopts)
+        tuples where options is a dictionary as accepted by convert(). All
+        outputs must share the same sources. Outputs without a video stream,
+        such as audio only intermediates, are mapped as usual.
+
+        Returns a generator like convert(). Since every output is fed from
+        the same decode the reported progress applies to all outputs. See
+        convert() for the info and logfile arguments.
+
+        >>> conv = Converter().convert_ladder([
+        ...    ('/tmp/1080p.mp4', {'source': ['test1.mkv'], 'format': 'mp4', 'video': {'codec': 'h264', 'width': 1920}}, None),
+        ...    ('/tmp/720p.mp4', {'source': ['test1.mkv'], 'format': 'mp4', 'video': {'codec': 'h264', 'width': 1280}}, None),
+        ... ])
+
+        >>> for timecode, debug in conv:
+        ...   pass
+        """
+
+        if not outputs:
+            raise ConverterError('No outputs specified')
+
+        for _, options, _ in outputs:
+            if not isinstance(options, dict):
+                raise ConverterError('Invalid options')
+            if 'source' not in options:
+                raise ConverterError('No source specified')
+
+        infile = outputs[0][1]['source'][0]
+
+        info = info or self.ffmpeg.probe(infile)
+        if info is None:
+            raise ConverterError("Can't get information about source file")
+
+        if not info.video:
+            raise ConverterError('Source file has no video stream')
+
+        if not info.format.duration:
+            info.format.duration = 0.01
+
+        if info.format.duration < 0.01:
+            raise ConverterError('Zero-length media')
+
+        sources = None
+        parsed = []
+        for outfile, options, postopts in outputs:
+            options = options.copy()
+            if 'video' in options:
+                v = options['video'] = options['video'].copy()
+                v['src_width'] = info.video.video_width
+                v['src_height'] = info.video.video_height
+
+            graph = FilterGraph()
+            source_options, optlist = self._split_source_options(self.parse_options(options, strip_metadata=strip_metadata, graph=graph))
+            if sources is None:
+                sources = source_options
+            elif sources != source_options:
+                raise ConverterError('All ladder outputs must share the same sources')
+
+            vmap = None
+            if '-vcodec' in optlist and optlist[optlist.index('-vcodec') + 1] != 'copy':
+                i = optlist.index('-vcodec') + 2
+                if i < len(optlist) and optlist[i] == '-map':
+                    vmap = i + 1
+            parsed.append([outfile, optlist, postopts, graph, vmap])
+
+        # Build the filter graph, applying filters common to all outputs before the split
+        split = [x for x in parsed if x[4] is not None]
+        filter_complex = None
+        if split:
+            filter_complex, labels = FilterGraph.split(split[0][1][split[0][4]], [x[3] for x in split])
+            for label, x in zip(labels, split):
+                x[1][x[4]] = label
+
+        optlist = list(sources)
+        if filter_complex:
+            optlist.extend(['-filter_complex', filter_complex])
+        for outfile, opts, postopts, _, _ in parsed[:-1]:
+            optlist.extend(opts)
+            if postopts:
+                optlist.extend(postopts)
+            optlist.extend(['-y', outfile])
+
+        outfile, opts, postopts, _, _ = parsed[-1]
+        optlist.extend(opts)
+        for timecode, debug in self.ffmpeg.convert(outfile,
+                                                   optlist,
+                                                   timeout=timeout,
+                                                   preopts=preopts,
+                                                   postopts=postopts,
+                                                   logfile=logfile):
+            yield int((100.0 * timecode) / info.format.duration), debug
+
     def probe(self, fname, posters_as_video=True):
         """
         Examine the media file. See the documentation of
@@ -342,6 +480,52 @@ class Converter(object):
         except FFMpegError:
             return None
 
+    def idet(self, fname, start=0, frames=200):
+        """
+        Detect interlacing over a number of frames. See the documentation
+        of converter.FFMpeg.idet() for details.
+        """
+        try:
+            return self.ffmpeg.idet(fname, start, frames)
+        except FFMpegError:
+            return None
+
+    def cropdetect(self, fname, start=0, frames=12):
+        """
+        Detect black borders over a number of keyframes. See the
+        documentation of converter.FFMpeg.cropdetect() for details.
+        """
+        try:
+            return self.ffmpeg.cropdetect(fname, start, frames)
+        except FFMpegError:
+            return None
+
+    def get_result(self, fname, name):
+        """
+        Return an analysis result cached along with the probe of a file,
+        see converter.ProbeCache.get_result().
+        """
+        if self.ffmpeg.cache:
+            return self.ffmpeg.cache.get_result(fname, name)
+        return None
+
+    def put_result(self, fname, name, value):
+        """
+        Cache an analysis result along with the probe of a file.
+        """
+        if self.ffmpeg.cache:
+            self.ffmpeg.cache.put_result(fname, name, value)
+
+    def peak_bitrate(self, fname, window=1.0, stream='v:0'):
+        """
+        Measure the peak bitrate of a stream. See the documentation of
+        converter.FFMpeg.peak_bitrate() for details.
+        """
+        try:
+            return self.ffmpeg.peak_bitrate(fname, window, stream)
+        except FFMpegError:
+            return None
+
     def thumbnail(self, fname, time, outfile, size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
         """
         Create a thumbnail of the media file. See the documentation of
@@ -349,9 +533,16 @@ class Converter(object):
         """
         return self.ffmpeg.thumbnail(fname, time, outfile, size, quality)
 
-    def thumbnails(self, fname, option_list):
+    def thumbnails(self, fname, option_list, keyframes=False):
         """
         Create one or more thumbnail of the media file. See the documentation
         of converter.FFMpeg.thumbnails() for details.
         """
-        return self.ffmpeg.thumbnails(fname, option_list)
+        return self.ffmpeg.thumbnails(fname, option_list, keyframes)
+
+    def tile(self, pattern, start, columns, rows, outfile, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
+        """
+        Tile numbered images into a sprite sheet. See the documentation of
+        converter.FFMpeg.tile() for details.
+        """
+        return self.ffmpeg.tile(pattern, start, columns, rows, outfile, quality)
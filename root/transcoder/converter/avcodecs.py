@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+from converter.filtergraph import Filter, FilterGraph
+
 
 class BaseCodec(object):
     """
@@ -39,6 +41,9 @@ class BaseCodec(object):
     def _codec_specific_produce_ffmpeg_list(self, safe, stream=0):
         return []
 
+    def _codec_specific_filters(self, safe, graph):
+        pass
+
     def safe_disposition(self, dispo):
         dispo = dispo or ""
         for d in self.DISPOSITIONS:
@@ -260,6 +265,13 @@ class VideoCodec(BaseCodec):
             * pad - pad with black bars
       * src_width (int) - source width
       * src_height (int) - source height
+      * crop (string) - w:h:x:y area of the source to keep, applied
+            before scaling
+
+    Filters are added to a FilterGraph, which is rendered as a -vf option
+    unless one is passed to parse_options to be combined into a
+    -filter_complex by the caller. Codecs contribute their own filters,
+    such as scaling or hardware uploads, in _codec_specific_filters.
 
     Aspect preserval mode is only used if both source
     and both destination sizes are specified. If source
@@ -288,6 +300,7 @@ class VideoCodec(BaseCodec):
         'src_width': int,
         'src_height': int,
         'filter': str,
+        'crop': str,
         'pix_fmt': str,
         'field_order': str,
         'map': int
@@ -329,12 +342,12 @@ class VideoCodec(BaseCodec):
                 h0 = int(w / aspect)
                 assert h0 > h, (sw, sh, w, h)
                 dh = (h0 - h) / 2
-                return w, h0, 'crop=%d:%d:0:%d' % (w, h, dh)
+                return w, h0, [Filter('crop', w, h, 0, int(dh))]
             else:  # source is wider, need to crop left/right
                 w0 = int(h * aspect)
                 assert w0 > w, (sw, sh, w, h)
                 dw = (w0 - w) / 2
-                return w0, h, 'crop=%d:%d:%d:0' % (w, h, dw)
+                return w0, h, [Filter('crop', w, h, int(dw), 0)]
 
         if mode == 'pad':
             # target is taller, need to pad top/bottom
@@ -342,16 +355,33 @@ class VideoCodec(BaseCodec):
                 h1 = int(w / aspect)
                 assert h1 < h, (sw, sh, w, h)
                 dh = (h - h1) / 2
-                return w, h1, 'pad=%d:%d:0:%d' % (w, h, dh)  # FIXED
+                return w, h1, [Filter('pad', w, h, 0, int(dh))]  # FIXED
             else:  # target is wider, need to pad left/right
                 w1 = int(h * aspect)
                 assert w1 < w, (sw, sh, w, h)
                 dw = (w - w1) / 2
-                return w1, h, 'pad=%d:%d:%d:0' % (w, h, dw)  # FIXED
+                return w1, h, [Filter('pad', w, h, int(dw), 0)]  # FIXED
 
         assert False, mode
 
-    def parse_options(self, opt, stream=0):
+    def _scale(self, safe, w, h, named=False):
+        """
+        Scale filter to w x h, when only one of them is given the other
+        keeps the aspect ratio rounded to an even number. Returns None if
+        there is nothing to scale or the frames reaching the scale stage
+        already have that size, so they aren't scaled for nothing.
+        """
+        if not w and not h:
+            return None
+        if 'src_size' in safe:
+            sw, sh = safe['src_size']
+            if (w == sw or not w and sw % 2 == 0) and (h == sh or not h and sh % 2 == 0):
+                return None
+        w = w or 'trunc((oh*a)/2)*2'
+        h = h or 'trunc(ow/a/2)*2'
+        return Filter(self.scale_filter, w=w, h=h) if named else Filter(self.scale_filter, w, h)
+
+    def parse_options(self, opt, stream=0, graph=None):
         super(VideoCodec, self).parse_options(opt)
 
         safe = self.safe_options(opt)
@@ -375,6 +405,11 @@ class VideoCodec(BaseCodec):
             if safe['field_order'] not in ['progressive', 'tt', 'bb', 'tb', 'bt']:
                 del safe['field_order']
 
+        if 'crop' in safe:
+            parts = safe['crop'].split(':')
+            if len(parts) != 4 or not all(x.isdigit() for x in parts):
+                del safe['crop']
+
         w = None
         h = None
 
@@ -400,6 +435,10 @@ class VideoCodec(BaseCodec):
                 sw = None
                 sh = None
 
+        # Scaling sees the cropped picture, so aspect corrections work from its size
+        if 'crop' in safe:
+            sw, sh = [int(x) for x in safe['crop'].split(':')[:2]]
+
         mode = 'stretch'
         if 'mode' in safe:
             if safe['mode'] in ['stretch', 'crop', 'pad']:
@@ -411,6 +450,8 @@ class VideoCodec(BaseCodec):
         safe['width'] = w
         safe['height'] = h
         safe['aspect_filters'] = filters
+        if sw and sh:
+            safe['src_size'] = (sw, sh)
 
         if w and h:
             safe['aspect'] = '%d:%d' % (w, h)
@@ -446,10 +487,6 @@ class VideoCodec(BaseCodec):
         if 'bitrate' in safe:
             optlist.extend(['-metadata:s:v', 'BPS=' + str(safe['bitrate'] * 1000)])
             optlist.extend(['-metadata:s:v', 'BPS-eng=' + str(safe['bitrate'] * 1000)])
-        if 'filter' in safe:
-            optlist.extend(['-vf', str(safe['filter'])])
-        if filters:
-            optlist.extend(['-vf', filters])
         if w and h:
             optlist.extend(['-s', '%dx%d' % (w, h)])
             if ow and oh:
@@ -463,18 +500,18 @@ class VideoCodec(BaseCodec):
 
         optlist.extend(self._codec_specific_produce_ffmpeg_list(safe))
 
-        # consolidate filters
-        if optlist.count('-vf') > 1:
-            vf = []
-            while optlist.count('-vf') > 0:
-                vf.append(optlist.pop(optlist.index('-vf') + 1))
-                del optlist[optlist.index('-vf')]
-
-            vfstring = ""
-            for line in vf:
-                vfstring = "%s,%s" % (vfstring, line)
+        # Filters go into the graph by stage, a graph passed in is rendered by the caller as part of a -filter_complex
+        vgraph = graph if graph is not None else FilterGraph()
+        if 'crop' in safe:
+            vgraph.add('crop', Filter('crop', *safe['crop'].split(':')))
+        if 'filter' in safe:
+            vgraph.add('filter', safe['filter'])
+        if filters:
+            vgraph.add('aspect', *filters)
+        self._codec_specific_filters(safe, vgraph)
 
-            optlist.extend(['-vf', vfstring[1:]])
+        if graph is None and vgraph:
+            optlist.extend(['-vf', str(vgraph)])
 
         return optlist
 
@@ -973,14 +1010,11 @@ class H264Codec(VideoCodec):
             optlist.extend(['-%s' % self.codec_params, safe['params']])
         if 'tune' in safe:
             optlist.extend(['-tune', safe['tune']])
-        if 'wscale' in safe and 'hscale' in safe:
-            optlist.extend(['-vf', '%s=%s:%s' % (self.scale_filter, safe['wscale'], safe['hscale'])])
-        elif 'wscale' in safe:
-            optlist.extend(['-vf', '%s=%s:trunc(ow/a/2)*2' % (self.scale_filter, safe['wscale'])])
-        elif 'hscale' in safe:
-            optlist.extend(['-vf', '%s=trunc((oh*a)/2)*2:%s' % (self.scale_filter, safe['hscale'])])
         return optlist
 
+    def _codec_specific_filters(self, safe, graph):
+        graph.add('scale', self._scale(safe, safe.get('wscale'), safe.get('hscale')))
+
 
 class H264CodecAlt(H264Codec):
     """
@@ -1006,12 +1040,17 @@ class NVEncH264Codec(H264Codec):
         optlist = super(NVEncH264Codec, self)._codec_specific_produce_ffmpeg_list(safe, stream)
         if 'device' in safe:
             optlist.extend(['-filter_hw_device', safe['device']])
-            if 'decode_device' in safe and safe['decode_device'] != safe['device']:
-                optlist.extend(['-vf', 'hwdownload,format=nv12,hwupload'])
-        elif 'decode_device' in safe:
-            optlist.extend(['-vf', 'hwdownload,format=nv12,hwupload'])
         return optlist
 
+    # Frames decoded on another device are downloaded ahead of any software filter, and scaled once uploaded again
+    def _codec_specific_filters(self, safe, graph):
+        scale = self._scale(safe, safe.get('wscale'), safe.get('hscale'))
+        if 'decode_device' in safe and safe['decode_device'] != safe.get('device'):
+            graph.add('hwdownload', Filter('hwdownload'), Filter('format', 'nv12'))
+            graph.add('hwupload', Filter('hwupload'), scale)
+        else:
+            graph.add('scale', scale)
+
 
 class VideotoolboxEncH264(H264Codec):
     """
@@ -1076,26 +1115,21 @@ class H264VAAPICodec(H264Codec):
 
         if 'device' in safe:
             optlist.extend(['-filter_hw_device', safe['device']])
-            if 'decode_device' in safe and safe['decode_device'] != safe['device']:
-                optlist.extend(['-vf', 'hwdownload'])
         else:
             optlist.extend(['-vaapi_device', '/dev/dri/renderD128'])
-            if 'decode_device' in safe:
-                optlist.extend(['-vf', 'hwdownload'])
+        return optlist
+
+    # Software filters run on downloaded frames, scaling and pixel format conversion happen after the upload
+    def _codec_specific_filters(self, safe, graph):
+        if 'decode_device' in safe and safe['decode_device'] != safe.get('device'):
+            graph.add('hwdownload', Filter('hwdownload'))
 
+        scale = self._scale(safe, safe.get('vaapi_wscale'), safe.get('vaapi_hscale'), named=True)
+        if 'vaapi_pix_fmt' in safe:
+            scale = scale or Filter(self.scale_filter)
+            scale.kwargs['format'] = safe['vaapi_pix_fmt']
         fmt = safe['vaapi_pix_fmt'] if 'vaapi_pix_fmt' in safe else self.default_fmt
-        fmtstr = ':format=%s' % safe['vaapi_pix_fmt'] if 'vaapi_pix_fmt' in safe else ""
-
-        if 'vaapi_wscale' in safe and 'vaapi_hscale' in safe:
-            optlist.extend(['-vf', 'format=%s|vaapi,hwupload,%s=w=%s:h=%s%s' % (fmt, self.scale_filter, safe['vaapi_wscale'], safe['vaapi_hscale'], fmtstr)])
-        elif 'vaapi_wscale' in safe:
-            optlist.extend(['-vf', 'format=%s|vaapi,hwupload,%s=w=%s:h=trunc(ow/a/2)*2%s' % (fmt, self.scale_filter, safe['vaapi_wscale'], fmtstr)])
-        elif 'vaapi_hscale' in safe:
-            optlist.extend(['-vf', 'format=%s|vaapi,hwupload,%s=w=trunc((oh*a)/2)*2:h=%s%s' % (fmt, self.scale_filter, safe['vaapi_hscale'], fmtstr)])
-        else:
-            fmtstr = ",%s=%s" % (self.scale_filter, fmtstr[1:]) if fmtstr else ""
-            optlist.extend(['-vf', "format=%s|vaapi,hwupload%s" % (fmt, fmtstr)])
-        return optlist
+        graph.add('hwupload', Filter('format', '%s|vaapi' % fmt), Filter('hwupload'), scale)
 
 
 class H264QSVCodec(H264Codec):
@@ -1219,15 +1253,12 @@ class H265Codec(VideoCodec):
             optlist.extend(['-%s' % self.codec_params, params])
         if 'tune' in safe:
             optlist.extend(['-tune', safe['tune']])
-        if 'wscale' in safe and 'hscale' in safe:
-            optlist.extend(['-vf', '%s=%s:%s' % (self.scale_filter, safe['wscale'], safe['hscale'])])
-        elif 'wscale' in safe:
-            optlist.extend(['-vf', '%s=%s:trunc(ow/a/2)*2' % (self.scale_filter, safe['wscale'])])
-        elif 'hscale' in safe:
-            optlist.extend(['-vf', '%s=trunc((oh*a)/2)*2:%s' % (self.scale_filter, safe['hscale'])])
         optlist.extend(['-tag:v', 'hvc1'])
         return optlist
 
+    def _codec_specific_filters(self, safe, graph):
+        graph.add('scale', self._scale(safe, safe.get('wscale'), safe.get('hscale')))
+
 
 class H265CodecAlt(H265Codec):
     """
@@ -1362,26 +1393,21 @@ class H265VAAPICodec(H265Codec):
 
         if 'device' in safe:
             optlist.extend(['-filter_hw_device', safe['device']])
-            if 'decode_device' in safe and safe['decode_device'] != safe['device']:
-                optlist.extend(['-vf', 'hwdownload'])
         else:
             optlist.extend(['-vaapi_device', '/dev/dri/renderD128'])
-            if 'decode_device' in safe:
-                optlist.extend(['-vf', 'hwdownload'])
+        return optlist
 
+    # Software filters run on downloaded frames, scaling and pixel format conversion happen after the upload
+    def _codec_specific_filters(self, safe, graph):
+        if 'decode_device' in safe and safe['decode_device'] != safe.get('device'):
+            graph.add('hwdownload', Filter('hwdownload'))
+
+        scale = self._scale(safe, safe.get('vaapi_wscale'), safe.get('vaapi_hscale'), named=True)
+        if 'vaapi_pix_fmt' in safe:
+            scale = scale or Filter(self.scale_filter)
+            scale.kwargs['format'] = safe['vaapi_pix_fmt']
         fmt = safe['vaapi_pix_fmt'] if 'vaapi_pix_fmt' in safe else self.default_fmt
-        fmtstr = ':format=%s' % safe['vaapi_pix_fmt'] if 'vaapi_pix_fmt' in safe else ""
-
-        if 'vaapi_wscale' in safe and 'vaapi_hscale' in safe:
-            optlist.extend(['-vf', 'format=%s|vaapi,hwupload,%s=w=%s:h=%s%s' % (fmt, self.scale_filter, safe['vaapi_wscale'], safe['vaapi_hscale'], fmtstr)])
-        elif 'vaapi_wscale' in safe:
-            optlist.extend(['-vf', 'format=%s|vaapi,hwupload,%s=w=%s:h=trunc(ow/a/2)*2%s' % (fmt, self.scale_filter, safe['vaapi_wscale'], fmtstr)])
-        elif 'vaapi_hscale' in safe:
-            optlist.extend(['-vf', 'format=%s|vaapi,hwupload,%s=w=trunc((oh*a)/2)*2:h=%s%s' % (fmt, self.scale_filter, safe['vaapi_hscale'], fmtstr)])
-        else:
-            fmtstr = ",%s=%s" % (self.scale_filter, fmtstr[1:]) if fmtstr else ""
-            optlist.extend(['-vf', "format=%s|vaapi,hwupload%s" % (fmt, fmtstr)])
-        return optlist
+        graph.add('hwupload', Filter('format', '%s|vaapi' % fmt), Filter('hwupload'), scale)
 
 
 class NVEncH265Codec(H265Codec):
@@ -1401,12 +1427,17 @@ class NVEncH265Codec(H265Codec):
         optlist = super(NVEncH265Codec, self)._codec_specific_produce_ffmpeg_list(safe, stream)
         if 'device' in safe:
             optlist.extend(['-filter_hw_device', safe['device']])
-            if 'decode_device' in safe and safe['decode_device'] != safe['device']:
-                optlist.extend(['-vf', 'hwdownload,format=nv12,hwupload'])
-        elif 'decode_device' in safe:
-            optlist.extend(['-vf', 'hwdownload,format=nv12,hwupload'])
         return optlist
 
+    # Frames decoded on another device are downloaded ahead of any software filter, and scaled once uploaded again
+    def _codec_specific_filters(self, safe, graph):
+        scale = self._scale(safe, safe.get('wscale'), safe.get('hscale'))
+        if 'decode_device' in safe and safe['decode_device'] != safe.get('device'):
+            graph.add('hwdownload', Filter('hwdownload'), Filter('format', 'nv12'))
+            graph.add('hwupload', Filter('hwupload'), scale)
+        else:
+            graph.add('scale', scale)
+
 
 class NVEncH265CodecAlt(NVEncH265Codec):
     """
@@ -1492,20 +1523,12 @@ class MpegCodec(VideoCodec):
     # again in vf; take care to put it *before* crop/pad, so
     # it uses the same adjusted dimensions as the codec itself
     # (pad/crop will adjust it further if neccessary)
-    def _codec_specific_parse_options(self, safe, stream=0):
+    def _codec_specific_filters(self, safe, graph):
         w = safe['width']
         h = safe['height']
 
         if w and h:
-            filters = safe['aspect_filters']
-            tmp = 'aspect=%d:%d' % (w, h)
-
-            if filters is None:
-                safe['aspect_filters'] = tmp
-            else:
-                safe['aspect_filters'] = tmp + ',' + filters
-
-        return safe
+            graph.insert('aspect', Filter('aspect', '%d:%d' % (w, h)))
 
 
 class Mpeg1Codec(MpegCodec):
@@ -7,8 +7,16 @@ import signal
 from subprocess import Popen, PIPE
 import logging
 import locale
+import codecs
 import json
+import tempfile
+import threading
+from collections import deque, OrderedDict
 from converter.avcodecs import BaseCodec, video_codec_list
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 
 console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
@@ -49,6 +57,342 @@ class FFMpegConvertError(Exception):
         return self.__repr__()
 
 
+class ProgressEvent(object):
+    """
+    One block of ffmpeg -progress output. The attributes are:
+      * frame - frames encoded so far
+      * fps - encoding frame rate
+      * bitrate - output bitrate so far (kbps)
+      * total_size - output size so far (bytes)
+      * out_time_us - output timestamp reached (microseconds)
+      * speed - encoding speed as a multiple of realtime
+      * dup_frames - frames duplicated to keep the output frame rate
+      * drop_frames - frames dropped to keep the output frame rate
+      * progress - 'continue', or 'end' for the last block
+    """
+
+    def __init__(self, values):
+        self.frame = self.parse_number(values.get('frame'), int)
+        self.fps = self.parse_number(values.get('fps'), float)
+        self.bitrate = self.parse_number(values.get('bitrate', '').replace('kbits/s', ''), float)
+        self.total_size = self.parse_number(values.get('total_size'), int)
+        # Older ffmpeg only reports out_time_ms, which despite its name is also in microseconds
+        self.out_time_us = self.parse_number(values.get('out_time_us', values.get('out_time_ms')), int)
+        self.speed = self.parse_number(values.get('speed', '').replace('x', ''), float)
+        self.dup_frames = self.parse_number(values.get('dup_frames'), int)
+        self.drop_frames = self.parse_number(values.get('drop_frames'), int)
+        self.progress = values.get('progress')
+
+    @staticmethod
+    def parse_number(val, type):
+        try:
+            return type(val.strip())
+        except:
+            return None
+
+    @property
+    def timecode(self):
+        return (self.out_time_us or 0) / 1000000.0
+
+    def eta(self, complete):
+        """
+        Seconds left until the encode reaches 100 percent, estimated from
+        the current percentage and encoding speed.
+        """
+        if not self.speed or not complete or complete >= 100:
+            return None
+        return self.timecode * (100.0 - complete) / complete / self.speed
+
+    def __str__(self):
+        return 'frame=%s fps=%s bitrate=%skbits/s size=%skB time=%.2f dup=%s drop=%s speed=%sx' % (
+            self.frame, self.fps, self.bitrate, (self.total_size or 0) // 1024,
+            self.timecode, self.dup_frames, self.drop_frames, self.speed)
+
+    def __repr__(self):
+        return '<ProgressEvent %s>' % self.__str__()
+
+
+class FFMpegOutput(object):
+    """
+    Parses the stderr of an ffmpeg process started with -progress pipe:2,
+    fed in blocks of raw bytes. Progress blocks come out as ProgressEvent
+    objects, only the last tail_lines lines of regular log output are kept
+    in memory and the full log is optionally streamed to logfile.
+    """
+    PROGRESS_PATTERN = re.compile(r'^([a-z0-9_]+)=\s*(\S*)$')
+
+    def __init__(self, cmds, tail_lines=50, logfile=None):
+        self.tail = deque(maxlen=tail_lines)
+        self.received = False
+        self.yielded = False
+        self.buf = ''
+        self.values = {}
+        # Blocks can end partway through a multibyte character, the incremental decoder holds it over to the next block
+        self.decoder = codecs.getincrementaldecoder(console_encoding)(errors='ignore')
+
+        self.spill = None
+        if logfile:
+            try:
+                self.spill = open(logfile, 'w', encoding='utf-8')
+                self.spill.write(' '.join(cmds) + '\n\n')
+            except (IOError, OSError):
+                logging.getLogger(__name__).exception("Unable to write ffmpeg log to %s." % logfile)
+
+    def feed(self, data):
+        """
+        Parse a block of stderr output, returning the progress events it
+        completed.
+        """
+        events = []
+        self.buf += self.decoder.decode(data).replace('\r', '\n')
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            # Progress blocks are key=value lines ending with a progress key, anything else is regular log output
+            match = self.PROGRESS_PATTERN.match(line)
+            if not match:
+                self.log(line)
+                continue
+            self.values[match.group(1)] = match.group(2)
+            if match.group(1) == 'progress':
+                events.append(ProgressEvent(self.values))
+                self.values = {}
+                self.yielded = True
+        return events
+
+    def log(self, line):
+        self.received = True
+        self.tail.append(line)
+        if self.spill:
+            self.spill.write(line + '\n')
+
+    def close(self):
+        if self.buf:
+            self.log(self.buf)
+            self.buf = ''
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+    def check(self, cmds, infile, returncode, pid=0):
+        """
+        Raise the appropriate error if the ffmpeg process failed, judged
+        from the last line of its output and its exit code.
+        """
+        if not self.received:
+            raise FFMpegError('Error while calling ffmpeg binary')
+
+        total_output = '\n'.join(self.tail) + '\n'
+        cmd = ' '.join(cmds)
+        if self.tail:
+            line = self.tail[-1]
+
+            if line.startswith('Received signal'):
+                # Received signal 15: terminating.
+                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=pid)
+            if line.startswith(infile + ': '):
+                err = line[len(infile) + 2:]
+                raise FFMpegConvertError('Encoding error', cmd, total_output,
+                                         err, pid=pid)
+            if line.startswith('Error while '):
+                raise FFMpegConvertError('Encoding error', cmd, total_output,
+                                         line, pid=pid)
+            if not self.yielded:
+                raise FFMpegConvertError('Unknown ffmpeg error', cmd,
+                                         total_output, line, pid=pid)
+        if returncode != 0:
+            raise FFMpegConvertError('Exited with code %d' % returncode, cmd,
+                                     total_output, pid=pid)
+
+
+class ProbeCache(object):
+    """
+    Cache of ffprobe output keyed by file identity (device, inode, size and
+    modification time), so a file is only probed again once it changes.
+    Results of analysing a file (as JSON-serializable values under a name)
+    are kept with its probe. The most recently used entries are kept in
+    memory, if a path is given every entry is also stored in an SQLite
+    database there so it survives between runs.
+
+    >>> cache = ProbeCache(path='/config/probes.db')
+    >>> f = FFMpeg(cache=cache)
+    """
+
+    def __init__(self, size=128, path=None):
+        self.size = size
+        self.entries = OrderedDict()
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path and sqlite3:
+            try:
+                self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+                self.db.execute('CREATE TABLE IF NOT EXISTS probes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                                'path TEXT, output TEXT, framedata TEXT, PRIMARY KEY (dev, ino, size, mtime_ns))')
+                self.db.execute('CREATE INDEX IF NOT EXISTS probes_path ON probes (path)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS results (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                                'path TEXT, name TEXT, value TEXT, PRIMARY KEY (dev, ino, size, mtime_ns, name))')
+                self.db.execute('CREATE INDEX IF NOT EXISTS results_path ON results (path)')
+                self.db.commit()
+            except sqlite3.Error:
+                logging.getLogger(__name__).exception("Unable to open probe cache %s, caching in memory only." % path)
+                self.db = None
+
+    @staticmethod
+    def key(fname):
+        st = os.stat(fname)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, fname):
+        """
+        Return the cached (ffprobe output, framedata) for a file, or None if
+        it hasn't been probed since it last changed.
+        """
+        try:
+            key = self.key(fname)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            if self.db:
+                try:
+                    row = self.db.execute('SELECT output, framedata FROM probes WHERE dev=? AND ino=? AND size=? AND mtime_ns=?', key).fetchone()
+                except sqlite3.Error:
+                    logging.getLogger(__name__).exception("Unable to read probe cache.")
+                    row = None
+                if row:
+                    entry = (row[0], json.loads(row[1]) if row[1] else None)
+                    self._remember(key, entry)
+                    return entry
+        return None
+
+    def put(self, fname, output, framedata=None):
+        try:
+            key = self.key(fname)
+        except OSError:
+            return
+
+        with self.lock:
+            self._remember(key, (output, framedata))
+            if self.db:
+                try:
+                    # Entries for an earlier version of the same path can never be hit again
+                    self.db.execute('DELETE FROM probes WHERE path=?', (os.path.abspath(fname),))
+                    self.db.execute('DELETE FROM results WHERE path=? AND NOT (dev=? AND ino=? AND size=? AND mtime_ns=?)', (os.path.abspath(fname),) + key)
+                    self.db.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    key + (os.path.abspath(fname), output, json.dumps(framedata) if framedata else None))
+                    self.db.commit()
+                except sqlite3.Error:
+                    logging.getLogger(__name__).exception("Unable to write probe cache.")
+
+    def invalidate(self, fname):
+        """
+        Drop a file from the cache, for use when a file is rewritten in a way
+        that may not change its size or modification time.
+        """
+        with self.lock:
+            try:
+                key = self.key(fname)
+                self.entries.pop(key, None)
+                self.results.pop(key, None)
+            except OSError:
+                pass
+            if self.db:
+                try:
+                    self.db.execute('DELETE FROM probes WHERE path=?', (os.path.abspath(fname),))
+                    self.db.execute('DELETE FROM results WHERE path=?', (os.path.abspath(fname),))
+                    self.db.commit()
+                except sqlite3.Error:
+                    logging.getLogger(__name__).exception("Unable to write probe cache.")
+
+    def get_result(self, fname, name):
+        """
+        Return the result of an analysis stored under name for a file, or
+        None if it hasn't been stored since the file last changed.
+        """
+        try:
+            key = self.key(fname)
+        except OSError:
+            return None
+
+        with self.lock:
+            results = self.results.get(key, {})
+            if name in results:
+                self.results.move_to_end(key)
+                return results[name]
+
+            if self.db:
+                try:
+                    row = self.db.execute('SELECT value FROM results WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND name=?', key + (name,)).fetchone()
+                except sqlite3.Error:
+                    logging.getLogger(__name__).exception("Unable to read probe cache.")
+                    row = None
+                if row:
+                    value = json.loads(row[0])
+                    self._remember_result(key, name, value)
+                    return value
+        return None
+
+    def put_result(self, fname, name, value):
+        try:
+            key = self.key(fname)
+        except OSError:
+            return
+
+        with self.lock:
+            self._remember_result(key, name, value)
+            if self.db:
+                try:
+                    self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    key + (os.path.abspath(fname), name, json.dumps(value)))
+                    self.db.commit()
+                except sqlite3.Error:
+                    logging.getLogger(__name__).exception("Unable to write probe cache.")
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _remember_result(self, key, name, value):
+        self.results.setdefault(key, {})[name] = value
+        self.results.move_to_end(key)
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+
+class Capabilities(object):
+    """
+    What a build of ffmpeg supports, discovered once per binary. The
+    attributes are:
+      * codecs - codec name to {'decoders': [...], 'encoders': [...]}
+      * hwaccels - hardware acceleration methods
+      * encoders - every encoder
+      * decoders - every decoder
+      * decoder_codec - decoder to the codec it decodes, built from codecs
+    """
+
+    def __init__(self, codecs, hwaccels, encoders, decoders):
+        self.codecs = codecs
+        self.hwaccels = hwaccels
+        self.encoders = encoders
+        self.decoders = decoders
+
+        self.decoder_codec = {}
+        for codec, coders in codecs.items():
+            for decoder in coders['decoders']:
+                self.decoder_codec.setdefault(decoder, codec)
+
+    @property
+    def json(self):
+        return {'codecs': self.codecs, 'hwaccels': self.hwaccels, 'encoders': self.encoders, 'decoders': self.decoders}
+
+
 class MediaFormatInfo(object):
     """
     Describes the media container format. The attributes are:
@@ -56,14 +400,28 @@ class MediaFormatInfo(object):
       * fullname - format full (descriptive) name
       * bitrate - total bitrate (bps)
       * duration - media duration in seconds
+      * start_time - timestamp of the earliest stream start in seconds
       * filesize - file size
     """
 
+    __slots__ = ['format', 'fullname', 'bitrate', 'duration', 'start_time', 'filesize', 'metadata']
+
+    # ffprobe entries parsed, key: (attribute, parser)
+    FIELDS = {
+        'format_name': ('format', lambda v: v),
+        'format_long_name': ('fullname', lambda v: v),
+        'bit_rate': ('bitrate', lambda v: MediaStreamInfo.parse_float(v, None)),
+        'duration': ('duration', lambda v: MediaStreamInfo.parse_float(v, None)),
+        'start_time': ('start_time', lambda v: MediaStreamInfo.parse_float(v, None)),
+        'size': ('filesize', lambda v: MediaStreamInfo.parse_float(v, None)),
+    }
+
     def __init__(self):
         self.format = None
         self.fullname = None
         self.bitrate = None
         self.duration = None
+        self.start_time = None
         self.filesize = None
         self.metadata = {}
 
@@ -71,18 +429,10 @@ class MediaFormatInfo(object):
         """
         Parse raw ffprobe output (key=value).
         """
-        if key == 'format_name':
-            self.format = val
-        elif key == 'format_long_name':
-            self.fullname = val
-        elif key == 'bit_rate':
-            self.bitrate = MediaStreamInfo.parse_float(val, None)
-        elif key == 'duration':
-            self.duration = MediaStreamInfo.parse_float(val, None)
-        elif key == 'size':
-            self.size = MediaStreamInfo.parse_float(val, None)
-
-        if key.startswith('TAG:'):
+        field = self.FIELDS.get(key)
+        if field:
+            setattr(self, field[0], field[1](val))
+        elif key.startswith('TAG:'):
             key = key.split('TAG:')[1].lower()
             value = val.lower().strip()
             self.metadata[key] = value
@@ -114,8 +464,49 @@ class MediaStreamInfo(object):
     Audio-specific attributes are:
       * audio_channels - the number of channels in the stream
       * audio_samplerate - sample rate (Hz)
+      * audio_channel_layout - channel layout (e.g. "stereo", "5.1(side)")
     """
 
+    __slots__ = ['index', 'type', 'codec', 'codec_desc', 'duration', 'bitrate', 'video_width', 'video_height', 'fps',
+                 'video_level', 'pix_fmt', 'profile', 'audio_channels', 'audio_samplerate', 'audio_channel_layout', 'attached_pic',
+                 'field_order', 'forced', 'default', 'metadata', 'disposition', 'color', 'framedata']
+
+    # ffprobe entries parsed for every stream, key: (attribute, parser)
+    FIELDS = {
+        'index': ('index', lambda s, v: MediaStreamInfo.parse_int(v)),
+        'codec_type': ('type', lambda s, v: v),
+        'codec_name': ('codec', lambda s, v: v.lower()),
+        'codec_long_name': ('codec_desc', lambda s, v: v),
+        'duration': ('duration', lambda s, v: MediaStreamInfo.parse_float(v)),
+        'bit_rate': ('bitrate', lambda s, v: MediaStreamInfo.parse_int(v, None)),
+        'width': ('video_width', lambda s, v: MediaStreamInfo.parse_int(v)),
+        'height': ('video_height', lambda s, v: MediaStreamInfo.parse_int(v)),
+        'channels': ('audio_channels', lambda s, v: MediaStreamInfo.parse_int(v)),
+        'sample_rate': ('audio_samplerate', lambda s, v: MediaStreamInfo.parse_int(v)),
+        'DISPOSITION:attached_pic': ('attached_pic', lambda s, v: MediaStreamInfo.parse_int(v)),
+        'profile': ('profile', lambda s, v: v.lower()),
+        'DISPOSITION:forced': ('forced', lambda s, v: MediaStreamInfo.parse_bool(MediaStreamInfo.parse_int(v))),
+        'DISPOSITION:default': ('default', lambda s, v: MediaStreamInfo.parse_bool(MediaStreamInfo.parse_int(v))),
+    }
+
+    # Entries only parsed for streams of a type, ffprobe lists them after codec_type
+    TYPE_FIELDS = {
+        'audio': {
+            'avg_frame_rate': ('fps', lambda s, v: MediaStreamInfo.parse_rate(v, s.fps)),
+            'channel_layout': ('audio_channel_layout', lambda s, v: v.lower()),
+        },
+        'video': {
+            'r_frame_rate': ('fps', lambda s, v: MediaStreamInfo.parse_rate(v, s.fps)),
+            'level': ('video_level', lambda s, v: s.parse_level(v)),
+            'pix_fmt': ('pix_fmt', lambda s, v: v.lower()),
+            'field_order': ('field_order', lambda s, v: v.lower()),
+        },
+    }
+    COLOR_FIELDS = {'color_range': 'range', 'color_space': 'space', 'color_transfer': 'transfer', 'color_primaries': 'primaries'}
+
+    # Codec classes converting ffprobe levels, by ffprobe codec name
+    LEVEL_CODECS = dict((x.ffprobe_codec_name, x) for x in reversed(video_codec_list))
+
     def __init__(self):
         self.index = None
         self.type = None
@@ -131,8 +522,11 @@ class MediaStreamInfo(object):
         self.profile = None
         self.audio_channels = None
         self.audio_samplerate = None
+        self.audio_channel_layout = None
         self.attached_pic = None
         self.field_order = None
+        self.forced = None
+        self.default = None
         self.metadata = {}
         self.disposition = {}
         self.color = {}
@@ -204,91 +598,48 @@ class MediaStreamInfo(object):
         except:
             return default
 
+    @staticmethod
+    def parse_rate(val, default=None):
+        if '/' in val:
+            n, d = val.split('/')
+            n = MediaStreamInfo.parse_float(n)
+            d = MediaStreamInfo.parse_float(d)
+            if n > 0.0 and d > 0.0:
+                return float(n) / float(d)
+            return default
+        elif '.' in val:
+            return MediaStreamInfo.parse_float(val)
+        return default
+
+    def parse_level(self, val):
+        level = self.parse_float(val)
+        codec_class = self.LEVEL_CODECS.get(self.codec)
+        if codec_class:
+            try:
+                return codec_class.codec_specific_level_conversion(level)
+            except:
+                pass
+        return level
+
     def parse_ffprobe(self, key, val):
         """
         Parse raw ffprobe output (key=value).
         """
-
-        if key == 'index':
-            self.index = self.parse_int(val)
-        elif key == 'codec_type':
-            self.type = val
-        elif key == 'codec_name':
-            self.codec = val.lower()
-        elif key == 'codec_long_name':
-            self.codec_desc = val
-        elif key == 'duration':
-            self.duration = self.parse_float(val)
-        elif key == 'bit_rate':
-            self.bitrate = self.parse_int(val, None)
-        elif key == 'width':
-            self.video_width = self.parse_int(val)
-        elif key == 'height':
-            self.video_height = self.parse_int(val)
-        elif key == 'channels':
-            self.audio_channels = self.parse_int(val)
-        elif key == 'sample_rate':
-            self.audio_samplerate = self.parse_int(val)
-        elif key == 'DISPOSITION:attached_pic':
-            self.attached_pic = self.parse_int(val)
-        elif key == 'profile':
-            self.profile = val.lower()
-        elif key == 'DISPOSITION:forced':
-            self.forced = self.parse_bool(self.parse_int(val))
-        elif key == 'DISPOSITION:default':
-            self.default = self.parse_bool(self.parse_int(val))
+        field = self.FIELDS.get(key) or self.TYPE_FIELDS.get(self.type, {}).get(key)
+        if field:
+            setattr(self, field[0], field[1](self, val))
+        elif self.type == 'video' and key in self.COLOR_FIELDS:
+            self.color[self.COLOR_FIELDS[key]] = val.lower()
 
         if key.startswith('TAG:'):
             key = key.split('TAG:')[1].lower()
             value = val.lower().strip()
             self.metadata[key] = value
-
-        if key.startswith('DISPOSITION:'):
+        elif key.startswith('DISPOSITION:'):
             key = key.split('DISPOSITION:')[1].lower()
             value = val.lower().strip()
             self.disposition[key] = self.parse_bool(self.parse_int(value))
 
-        if self.type == 'audio':
-            if key == 'avg_frame_rate':
-                if '/' in val:
-                    n, d = val.split('/')
-                    n = self.parse_float(n)
-                    d = self.parse_float(d)
-                    if n > 0.0 and d > 0.0:
-                        self.fps = float(n) / float(d)
-                elif '.' in val:
-                    self.fps = self.parse_float(val)
-
-        if self.type == 'video':
-            if key == 'r_frame_rate':
-                if '/' in val:
-                    n, d = val.split('/')
-                    n = self.parse_float(n)
-                    d = self.parse_float(d)
-                    if n > 0.0 and d > 0.0:
-                        self.fps = float(n) / float(d)
-                elif '.' in val:
-                    self.fps = self.parse_float(val)
-            elif key == 'level':
-                self.video_level = self.parse_float(val)
-                try:
-                    codec_class = next(x for x in video_codec_list if x.ffprobe_codec_name == self.codec)
-                    self.video_level = codec_class.codec_specific_level_conversion(self.video_level)
-                except:
-                    pass
-            elif key == 'pix_fmt':
-                self.pix_fmt = val.lower()
-            elif key == "field_order":
-                self.field_order = val.lower()
-            elif key == "color_range":
-                self.color['range'] = val.lower()
-            elif key == "color_space":
-                self.color['space'] = val.lower()
-            elif key == "color_transfer":
-                self.color['transfer'] = val.lower()
-            elif key == "color_primaries":
-                self.color['primaries'] = val.lower()
-
     def __repr__(self):
         d = ''
         metadata_str = ['%s=%s' % (key, value) for key, value
@@ -321,8 +672,14 @@ class MediaInfo(object):
       * format - a MediaFormatInfo object
       * streams - a list of MediaStreamInfo objects
       * path - path to file
+    Streams of each type are indexed once parsing is done, the video, audio,
+    subtitle, attachment and posters lists are shared and must not be
+    modified.
     """
 
+    __slots__ = ['format', 'posters_as_video', 'streams', 'framedata', 'path',
+                 '_video', '_posters', '_audio', '_subtitle', '_attachment']
+
     def __init__(self, posters_as_video=True):
         """
         :param posters_as_video: Take poster images (mainly for audio files) as
@@ -333,6 +690,27 @@ class MediaInfo(object):
         self.streams = []
         self.framedata = []
         self.path = None
+        self.index_streams()
+
+    def index_streams(self):
+        """
+        Build the per-type stream lists, called after parsing and again by
+        anyone changing streams directly.
+        """
+        self._video = None
+        self._posters = []
+        self._audio = []
+        self._subtitle = []
+        self._attachment = []
+        types = {'audio': self._audio, 'subtitle': self._subtitle, 'attachment': self._attachment}
+        for s in self.streams:
+            if s.attached_pic:
+                self._posters.append(s)
+            if s.type == 'video':
+                if self._video is None and (self.posters_as_video or not s.attached_pic):
+                    self._video = s
+            elif s.type in types:
+                types[s.type].append(s)
 
     @property
     def json(self):
@@ -343,10 +721,20 @@ class MediaInfo(object):
                 'subtitle': [x.json for x in self.subtitle],
                 'attachment': [x.json for x in self.attachment]}
 
+    # Entries of the first video frame kept as framedata
+    FRAMEDATA_KEYS = ['pix_fmt', 'color_space', 'color_primaries', 'color_transfer', 'side_data_list']
+
     def parse_ffprobe(self, raw):
         """
-        Parse raw ffprobe output.
+        Parse raw ffprobe output, either JSON or the legacy key=value format.
         """
+        if raw.lstrip().startswith('{'):
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                return
+            return self.parse_ffprobe_json(data)
+
         in_format = False
         current_stream = None
 
@@ -373,6 +761,54 @@ class MediaInfo(object):
                 elif in_format:
                     self.format.parse_ffprobe(k, v)
 
+        self.index_streams()
+
+    def parse_ffprobe_json(self, data):
+        """
+        Parse ffprobe -print_format json output. Entries are flattened to
+        the same key=value pairs as the legacy format (tags as TAG:key,
+        dispositions as DISPOSITION:key) so both share one parser. Frames,
+        if any were requested, are kept in framedata.
+        """
+        for stream in data.get('streams', []):
+            current_stream = MediaStreamInfo()
+            # Type and codec come first, the meaning of later entries depends on them
+            for k in ['codec_type', 'codec_name']:
+                if k in stream:
+                    current_stream.parse_ffprobe(k, str(stream[k]))
+            for k, v in self._flatten(stream):
+                current_stream.parse_ffprobe(k, v)
+            if current_stream.type:
+                self.streams.append(current_stream)
+
+        for k, v in self._flatten(data.get('format', {})):
+            self.format.parse_ffprobe(k, v)
+
+        self.framedata = data.get('frames', [])
+        self.index_streams()
+
+    @staticmethod
+    def _flatten(section):
+        for k, v in section.items():
+            if k == 'tags':
+                for tk, tv in v.items():
+                    yield 'TAG:' + tk, str(tv)
+            elif k == 'disposition':
+                for dk, dv in v.items():
+                    yield 'DISPOSITION:' + dk, str(dv)
+            elif not isinstance(v, (dict, list)):
+                yield k, str(v)
+
+    def first_frame(self, stream):
+        """
+        Entries of the first frame read from a stream, None if no frame of
+        it was read.
+        """
+        for frame in self.framedata:
+            if frame.get('stream_index') == stream.index:
+                return dict((k, frame[k]) for k in self.FRAMEDATA_KEYS if k in frame)
+        return None
+
     def __repr__(self):
         return 'MediaInfo(format=%s, streams=%s)' % (repr(self.format),
                                                      repr(self.streams))
@@ -382,47 +818,32 @@ class MediaInfo(object):
         """
         First video stream, or None if there are no video streams.
         """
-        for s in self.streams:
-            if s.type == 'video' and (self.posters_as_video or not s.attached_pic):
-                return s
-        return None
+        return self._video
 
     @property
     def posters(self):
-        return [s for s in self.streams if s.attached_pic]
+        return self._posters
 
     @property
     def audio(self):
         """
         All audio streams
         """
-        result = []
-        for s in self.streams:
-            if s.type == 'audio':
-                result.append(s)
-        return result
+        return self._audio
 
     @property
     def subtitle(self):
         """
         All subtitle streams
         """
-        result = []
-        for s in self.streams:
-            if s.type == 'subtitle':
-                result.append(s)
-        return result
+        return self._subtitle
 
     @property
     def attachment(self):
         """
         All attachment streams
         """
-        result = []
-        for s in self.streams:
-            if s.type == 'attachment':
-                result.append(s)
-        return result
+        return self._attachment
 
 
 class FFMpeg(object):
@@ -439,15 +860,30 @@ class FFMpeg(object):
         r' \(decoders: ([^)]+) \)')
     CODECS_ENCODERS_RE = re.compile(
         r' \(encoders: ([^)]+) \)')
+    IDET_MULTI_RE = re.compile(
+        r'Multi frame detection: TFF: *(\d+) BFF: *(\d+) Progressive: *(\d+) Undetermined: *(\d+)')
+    IDET_REPEATED_RE = re.compile(
+        r'Repeated Fields: Neither: *\d+ Top: *(\d+) Bottom: *(\d+)')
+    CROPDETECT_RE = re.compile(
+        r'crop=(\d+):(\d+):(\d+):(\d+)')
     DECODER_SYNONYMS = {
         'mpeg1video': 'mpeg1',
         'mpeg2video': 'mpeg2'}
+    LOG_TAIL_LINES = 50
+    # Capabilities already discovered in this process, by binary identity
+    CAPABILITIES = {}
+    # stderr is read in large blocks, ffmpeg reports progress about twice a second so a block rarely holds more than one report
+    READ_SIZE = 65536
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, cache=None, capabilities_file=None):
         """
         Initialize a new FFMpeg wrapper object. Optional parameters specify
-        the paths to ffmpeg and ffprobe utilities.
+        the paths to ffmpeg and ffprobe utilities, a ProbeCache to reuse
+        probe results from and a JSON file to persist discovered
+        capabilities in.
         """
+        self.cache = cache
+        self.capabilities_file = capabilities_file
 
         def which(name):
             path = os.environ.get('PATH', os.defpath)
@@ -477,8 +913,14 @@ class FFMpeg(object):
         if not os.path.exists(self.ffprobe_path):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
-    @property
-    def codecs(self):
+    def _capabilities_key(self):
+        key = []
+        for path in [self.ffmpeg_path, self.ffprobe_path]:
+            st = os.stat(path)
+            key.append('%s:%d:%d' % (os.path.realpath(path), st.st_size, st.st_mtime_ns))
+        return '|'.join(key)
+
+    def _discover_codecs(self):
         codecs = self._get_stdout([self.ffprobe_path, '-hide_banner', '-codecs'])
         codecs = {
             line_match.group(1): line_match.group(2)
@@ -490,19 +932,77 @@ class FFMpeg(object):
             codecs[codec] = dict(decoders=decoders_match and decoders_match.group(1).split() or [], encoders=encoders_match and encoders_match.group(1).split() or [])
         return codecs
 
+    def _discover(self):
+        hwaccels = [hwaccel.strip() for hwaccel in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-hwaccels']).split('\n')[1:] if hwaccel.strip()]
+        encoders = self._get_stdout([self.ffmpeg_path, '-hide_banner', '-encoders'])
+        decoders = self._get_stdout([self.ffmpeg_path, '-hide_banner', '-decoders'])
+        return Capabilities(self._discover_codecs(), hwaccels,
+                            [line_match.group(1) for line_match in self.CODECS_LINE_RE.finditer(encoders)],
+                            [line_match.group(1) for line_match in self.CODECS_LINE_RE.finditer(decoders)])
+
+    @property
+    def capabilities(self):
+        """
+        Capabilities of this ffmpeg build. Discovered once per binary (by
+        path, size and modification time) and kept in memory, and in
+        capabilities_file if one was given.
+        """
+        try:
+            key = self._capabilities_key()
+        except OSError:
+            return self._discover()
+
+        if key in self.CAPABILITIES:
+            return self.CAPABILITIES[key]
+
+        stored = {}
+        if self.capabilities_file and os.path.isfile(self.capabilities_file):
+            try:
+                with open(self.capabilities_file, 'r') as f:
+                    stored = json.load(f)
+                if key in stored:
+                    self.CAPABILITIES[key] = Capabilities(**stored[key])
+                    return self.CAPABILITIES[key]
+            except (IOError, OSError, ValueError, TypeError):
+                logging.getLogger(__name__).exception("Unable to read ffmpeg capabilities from %s." % self.capabilities_file)
+                stored = {}
+
+        capabilities = self._discover()
+        self.CAPABILITIES[key] = capabilities
+
+        if self.capabilities_file:
+            # Only the current build of each binary pair is worth keeping
+            paths = key.split('|')
+            stored = dict((k, v) for k, v in stored.items() if [x.rsplit(':', 2)[0] for x in k.split('|')] != [x.rsplit(':', 2)[0] for x in paths])
+            stored[key] = capabilities.json
+            # Every process writes its own temporary file so processes starting together can't corrupt each other's copy
+            tmp = None
+            try:
+                with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.capabilities_file)), suffix='.tmp', delete=False) as f:
+                    tmp = f.name
+                    json.dump(stored, f)
+                os.replace(tmp, self.capabilities_file)
+            except (IOError, OSError):
+                logging.getLogger(__name__).exception("Unable to write ffmpeg capabilities to %s." % self.capabilities_file)
+                if tmp and os.path.exists(tmp):
+                    os.remove(tmp)
+        return capabilities
+
+    @property
+    def codecs(self):
+        return self.capabilities.codecs
+
     @property
     def hwaccels(self):
-        return [hwaccel.strip() for hwaccel in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-hwaccels']).split('\n')[1:] if hwaccel.strip()]
+        return self.capabilities.hwaccels
 
     @property
     def encoders(self):
-        encoders = self._get_stdout([self.ffmpeg_path, '-hide_banner', '-encoders'])
-        return [line_match.group(1) for line_match in self.CODECS_LINE_RE.finditer(encoders)]
+        return self.capabilities.encoders
 
     @property
     def decoders(self):
-        decoders = self._get_stdout([self.ffmpeg_path, '-hide_banner', '-decoders'])
-        return [line_match.group(1) for line_match in self.CODECS_LINE_RE.finditer(decoders)]
+        return self.capabilities.decoders
 
     def hwaccel_decoder(self, video_codec, hwaccel):
         source_codec = self.DECODER_SYNONYMS.get(video_codec, video_codec)
@@ -528,19 +1028,110 @@ class FFMpeg(object):
         stdout_data, stderr = p.communicate()
         return stdout_data.decode(console_encoding, errors='ignore')
 
-    def framedata(self, fname):
-        try:
-            stdout_data = self._get_stdout([
-                self.ffprobe_path, '-hide_banner', '-loglevel', 'warning',
+    def _framedata_cmds(self, fname):
+        return [self.ffprobe_path, '-hide_banner', '-loglevel', 'warning',
                 '-select_streams', 'v:0', '-print_format', 'json',
                 '-show_frames', '-read_intervals', '%+#1',
                 '-show_entries', 'frame=color_space,color_primaries,color_transfer,side_data_list,pix_fmt',
                 '-probesize', '50M', '-analyzeduration', '100M',
-                '-i', fname])
+                '-i', fname]
+
+    def _probe_cmds(self, fname):
+        # Format, streams and the first frame in one pass, the frame carries the colour and HDR side data
+        return [self.ffprobe_path, '-hide_banner', '-loglevel', 'warning', '-print_format', 'json',
+                '-show_format', '-show_streams', '-show_frames', '-read_intervals', '%+#1', fname]
+
+    def framedata(self, fname):
+        try:
+            stdout_data = self._get_stdout(self._framedata_cmds(fname))
             return json.loads(stdout_data)['frames'][0]
         except:
             raise FFMpegError("Unable to obtain FFMPEG framedata")
 
+    def peak_bitrate(self, fname, window=1.0, stream='v:0'):
+        """
+        Measure the peak bitrate (bits per second) of a stream from its
+        packet sizes, averaged over a sliding window of the given length in
+        seconds.
+
+        >>> FFMpeg().peak_bitrate('test1.mkv', window=1.5)
+        7340032.0
+        """
+        p = self._spawn([
+            self.ffprobe_path, '-hide_banner', '-loglevel', 'error',
+            '-select_streams', stream, '-show_entries', 'packet=dts_time,size',
+            '-of', 'csv=p=0', fname])
+
+        packets = deque()
+        total = 0
+        peak = 0
+        for line in p.stdout:
+            try:
+                dts, size = line.decode(console_encoding, errors='ignore').strip().split(',')[:2]
+                dts = float(dts)
+                size = int(size)
+            except ValueError:
+                continue
+            packets.append((dts, size))
+            total += size
+            while packets[0][0] <= dts - window:
+                total -= packets.popleft()[1]
+            peak = max(peak, total)
+        p.communicate()
+
+        if p.returncode or not peak:
+            raise FFMpegError("Unable to read packets from " + fname)
+        return peak * 8 / window
+
+    def idet(self, fname, start=0, frames=200):
+        """
+        Run the idet filter over a number of frames of the first video
+        stream from a start time, returning its multi frame detection
+        counts ('tff', 'bff', 'progressive' and 'undetermined') along with
+        the number of frames with a repeated field ('repeated').
+
+        >>> FFMpeg().idet('test1.mkv', 600)
+        {'tff': 180, 'bff': 0, 'progressive': 12, 'undetermined': 8, 'repeated': 2}
+        """
+        cmds = [self.ffmpeg_path, '-hide_banner', '-nostats', '-ss', str(start), '-i', fname,
+                '-map', '0:V:0', '-an', '-sn', '-dn', '-vf', 'idet', '-frames:v', str(frames), '-f', 'null', '-']
+        p = self._spawn(cmds)
+        _, stderr_data = p.communicate()
+        stderr_data = stderr_data.decode(console_encoding, errors='ignore')
+
+        multi = self.IDET_MULTI_RE.search(stderr_data)
+        repeated = self.IDET_REPEATED_RE.search(stderr_data)
+        if not multi:
+            raise FFMpegError("Unable to read idet results for " + fname)
+        return {
+            'tff': int(multi.group(1)),
+            'bff': int(multi.group(2)),
+            'progressive': int(multi.group(3)),
+            'undetermined': int(multi.group(4)),
+            'repeated': int(repeated.group(1)) + int(repeated.group(2)) if repeated else 0
+        }
+
+    def cropdetect(self, fname, start=0, frames=12):
+        """
+        Run the cropdetect filter over a number of keyframes of the first
+        video stream from a start time, returning the (width, height, x, y)
+        rectangle that holds the picture of all of them.
+
+        >>> FFMpeg().cropdetect('test1.mkv', 600)
+        (1920, 800, 0, 140)
+        """
+        cmds = [self.ffmpeg_path, '-hide_banner', '-nostats', '-skip_frame', 'nokey', '-ss', str(start), '-i', fname,
+                '-map', '0:V:0', '-an', '-sn', '-dn', '-vf', 'cropdetect=round=2:reset=0', '-frames:v', str(frames), '-f', 'null', '-']
+        p = self._spawn(cmds)
+        _, stderr_data = p.communicate()
+        stderr_data = stderr_data.decode(console_encoding, errors='ignore')
+
+        # Without a reset every line covers all frames so far, the last one covers the whole sample
+        rects = self.CROPDETECT_RE.findall(stderr_data)
+        if not rects:
+            raise FFMpegError("Unable to read cropdetect results for " + fname)
+        return tuple(int(x) for x in rects[-1])
+
     def probe(self, fname, posters_as_video=True):
         """
         Examine the media file and determine its format and media streams.
@@ -572,17 +1163,31 @@ class FFMpeg(object):
         info = MediaInfo(posters_as_video)
         info.path = fname
 
-        stdout_data = self._get_stdout([
-            self.ffprobe_path, '-show_format', '-show_streams', fname])
+        cached = self.cache.get(fname) if self.cache else None
+        if cached:
+            stdout_data, framedata = cached
+        else:
+            stdout_data = self._get_stdout(self._probe_cmds(fname))
+            framedata = None
         info.parse_ffprobe(stdout_data)
 
         if not info.format.format and len(info.streams) == 0:
             return None
 
-        try:
-            info.video.framedata = self.framedata(fname)
-        except:
-            pass
+        if not cached and info.video:
+            framedata = info.first_frame(info.video)
+            # The first packet may belong to another stream, fall back to reading the video stream on its own
+            if framedata is None:
+                try:
+                    framedata = self.framedata(fname)
+                except:
+                    pass
+        if not cached:
+            if self.cache:
+                self.cache.put(fname, stdout_data, framedata)
+
+        if info.video and framedata:
+            info.video.framedata = framedata
 
         return info
 
@@ -600,7 +1205,7 @@ class FFMpeg(object):
             cmds.extend(['-f', 'null', '-'])
         return cmds
 
-    def convert(self, outfile, opts, timeout=10, preopts=None, postopts=None):
+    def convert(self, outfile, opts, timeout=10, preopts=None, postopts=None, logfile=None):
         """
         Convert the source media (infile) according to specified options
         (a list of ffmpeg switches as strings) and save it to outfile.
@@ -615,6 +1220,16 @@ class FFMpeg(object):
         the documentation in Converter.convert() for more details about this
         option.
 
+        Progress is requested from ffmpeg with -progress on stderr, each
+        yield after the first carries a ProgressEvent with the encode
+        statistics alongside the timecode.
+
+        Only the last LOG_TAIL_LINES lines of ffmpeg output are kept in
+        memory, for classifying errors. If logfile is given the full output
+        is streamed to it as well.
+
+        Closing the generator before it is exhausted kills ffmpeg.
+
         >>> conv = FFMpeg().convert('test.ogg', '/tmp/output.mp3',
         ...    ['-acodec libmp3lame', '-vn'])
         >>> for timecode, debug in conv:
@@ -632,6 +1247,7 @@ class FFMpeg(object):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
         cmds = self.generateCommands(outfile, opts, preopts, postopts)
+        cmds[1:1] = ['-progress', 'pipe:2', '-nostats']
 
         yield 0, cmds
 
@@ -647,81 +1263,41 @@ class FFMpeg(object):
         except OSError:
             raise FFMpegError('Error while calling ffmpeg binary')
 
-        yielded = False
-        buf = ''
-        total_output = ''
-        pat = re.compile(r'time=([0-9.:]+) ')
-        while True:
-            if timeout:
-                signal.alarm(timeout)
-
-            ret = p.stderr.read(10)
+        output = FFMpegOutput(cmds, self.LOG_TAIL_LINES, logfile)
+        try:
+            while True:
+                if timeout:
+                    signal.alarm(timeout)
 
-            if timeout:
-                signal.alarm(0)
+                ret = p.stderr.read1(self.READ_SIZE)
 
-            if not ret:
-                # For small or very fast jobs, ffmpeg may never output a '\r'.  When EOF is reached, yield if we haven't yet.
-                if not yielded:
-                    yielded = True
-                    yield 10, ""
-                break
+                if timeout:
+                    signal.alarm(0)
 
-            try:
-                ret = ret.decode(console_encoding)
-            except UnicodeDecodeError:
-                try:
-                    ret = ret.decode(console_encoding, errors="ignore")
-                except:
-                    pass
+                if not ret:
+                    # For small or very fast jobs, ffmpeg may never report progress.  When EOF is reached, yield if we haven't yet.
+                    if not output.yielded:
+                        output.yielded = True
+                        yield 10, ""
+                    break
 
-            total_output += ret
-            buf += ret
-            if '\r' in buf:
-                line, buf = buf.split('\r', 1)
-
-                tmp = pat.findall(line)
-                if len(tmp) == 1:
-                    timespec = tmp[0]
-                    if ':' in timespec:
-                        timecode = 0
-                        for part in timespec.split(':'):
-                            timecode = 60 * timecode + float(part)
-                    else:
-                        timecode = float(tmp[0])
-                    yielded = True
-                    debug = line.strip()
-                    debug = debug if debug.startswith("frame") else ""
-                    yield timecode, debug
+                for event in output.feed(ret):
+                    yield event.timecode, event
+        except:
+            # The conversion failed or the generator was closed before ffmpeg finished, don't leave it running
+            if p.poll() is None:
+                p.kill()
+                p.communicate()
+            raise
+        finally:
+            output.close()
 
         if timeout:
             signal.signal(signal.SIGALRM, signal.SIG_DFL)
 
         p.communicate()  # wait for process to exit
 
-        if total_output == '':
-            raise FFMpegError('Error while calling ffmpeg binary')
-
-        cmd = ' '.join(cmds)
-        if '\n' in total_output:
-            line = total_output.split('\n')[-2]
-
-            if line.startswith('Received signal'):
-                # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
-            if line.startswith(infile + ': '):
-                err = line[len(infile) + 2:]
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
-            if line.startswith('Error while '):
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
-            if not yielded:
-                raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+        output.check(cmds, infile, p.returncode, p.pid)
 
     def thumbnail(self, fname, time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY):
         """
@@ -736,12 +1312,17 @@ class FFMpeg(object):
         """
         return self.thumbnails(fname, [(time, outfile, size, quality)])
 
-    def thumbnails(self, fname, option_list):
+    def thumbnails(self, fname, option_list, keyframes=False):
         """
         Create one or more thumbnails of video.
         @param option_list: a list of tuples like:
             (time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY)
             see documentation of `converter.FFMpeg.thumbnail()` for details.
+        @param keyframes: grab the nearest keyframe at or before each time
+            instead of the exact frame, decoding only keyframes.
+
+        Every thumbnail seeks its own input, so ffmpeg never decodes from the
+        start of the file to reach a time point.
 
         >>> FFMpeg().thumbnails('test1.ogg', [(5, '/tmp/shot.png', '320x240'),
         >>>                                   (10, '/tmp/shot2.png', None, 5)])
@@ -749,21 +1330,44 @@ class FFMpeg(object):
         if not os.path.exists(fname):
             raise IOError('No such file: ' + fname)
 
-        cmds = [self.ffmpeg_path, '-i', fname, '-y', '-an']
+        cmds = [self.ffmpeg_path]
         for thumb in option_list:
+            if keyframes:
+                cmds.extend(['-skip_frame', 'nokey', '-noaccurate_seek'])
+            cmds.extend(['-ss', str(thumb[0]), '-i', fname])
+
+        cmds.append('-y')
+        for i, thumb in enumerate(option_list):
+            cmds.extend(['-map', '%d:V:0' % i, '-an', '-sn'])
             if len(thumb) > 2 and thumb[2]:
                 cmds.extend(['-s', str(thumb[2])])
 
             cmds.extend([
-                '-f', 'image2', '-vframes', '1',
-                '-ss', str(thumb[0]), thumb[1],
-                '-q:v', str(FFMpeg.DEFAULT_JPEG_QUALITY if len(thumb) < 4 else str(thumb[3])),
+                '-f', 'image2', '-frames:v', '1',
+                '-q:v', str(FFMpeg.DEFAULT_JPEG_QUALITY if len(thumb) < 4 else thumb[3]),
+                thumb[1]
             ])
 
         p = self._spawn(cmds)
         _, stderr_data = p.communicate()
         if stderr_data == '':
             raise FFMpegError('Error while calling ffmpeg binary')
-        stderr_data.decode(console_encoding)
+        stderr_data = stderr_data.decode(console_encoding, errors='ignore')
         if any(not os.path.exists(option[1]) for option in option_list):
             raise FFMpegError('Error creating thumbnail: %s' % stderr_data)
+
+    def tile(self, pattern, start, columns, rows, outfile, quality=DEFAULT_JPEG_QUALITY):
+        """
+        Tile up to columns * rows numbered images into a single sprite sheet.
+        @param pattern: image2 pattern of the images, like '/tmp/frame_%05d.jpg'
+        @param start: number of the first image to tile
+
+        >>> FFMpeg().tile('/tmp/frame_%05d.jpg', 100, 10, 10, '/tmp/sprite_1.jpg')
+        """
+        cmds = [self.ffmpeg_path, '-f', 'image2', '-start_number', str(start), '-i', pattern,
+                '-frames:v', '1', '-vf', 'tile=%dx%d' % (columns, rows), '-q:v', str(quality), '-y', outfile]
+
+        p = self._spawn(cmds)
+        _, stderr_data = p.communicate()
+        if not os.path.exists(outfile):
+            raise FFMpegError('Error creating sprite sheet: %s' % stderr_data.decode(console_encoding, errors='ignore'))
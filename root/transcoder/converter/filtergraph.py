@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+
+class Filter(object):
+    """
+    A single filter of a graph, its name and options. Positional options
+    are rendered first, followed by named ones.
+
+    >>> str(Filter('scale', 1280, 'trunc(ow/a/2)*2'))
+    'scale=1280:trunc(ow/a/2)*2'
+    >>> str(Filter('scale_vaapi', w=1280, h=720))
+    'scale_vaapi=w=1280:h=720'
+    """
+
+    __slots__ = ['name', 'args', 'kwargs']
+
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        options = [str(x) for x in self.args] + ['%s=%s' % (k, v) for k, v in self.kwargs.items()]
+        return '%s=%s' % (self.name, ':'.join(options)) if options else self.name
+
+    def __repr__(self):
+        return 'Filter(%s)' % str(self)
+
+    def __eq__(self, other):
+        return isinstance(other, Filter) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    @staticmethod
+    def parse(chain):
+        """
+        Split a filter chain as given to -vf into Filters. Commas that are
+        escaped, quoted or inside brackets don't separate filters.
+
+        >>> Filter.parse("bwdif=mode=send_field,select='eq(n,0)'")
+        [Filter(bwdif=mode=send_field), Filter(select='eq(n,0)')]
+        """
+        filters = []
+        current = ''
+        quote = False
+        depth = 0
+        escaped = False
+        for c in chain:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == "'":
+                quote = not quote
+            elif not quote and c in '([':
+                depth += 1
+            elif not quote and c in ')]':
+                depth -= 1
+            elif c == ',' and not quote and not depth:
+                filters.append(current)
+                current = ''
+                continue
+            current += c
+        filters.append(current)
+
+        result = []
+        for f in filters:
+            f = f.strip()
+            if f:
+                name, _, options = f.partition('=')
+                result.append(Filter(name, options) if options else Filter(name))
+        return result
+
+
+class FilterGraph(object):
+    """
+    The filters applied to a video output. Filters are grouped into stages
+    so the order they are added in doesn't matter:
+      * hwdownload - bring frames back from the decoding device
+      * crop - black border removal, ahead of everything else so later
+            filters handle fewer pixels
+      * filter - deinterlacing and other supplied filters
+      * scale - software scaling
+      * aspect - aspect ratio preserving crop or pad of the scaled picture
+      * hwupload - upload to the encoding device and any scaling there
+
+    A graph renders as a plain filter chain for -vf. Graphs of several
+    outputs of one source are combined with FilterGraph.split() into a
+    -filter_complex graph.
+
+    >>> graph = FilterGraph()
+    >>> graph.add('scale', Filter('scale', 1280, -2))
+    >>> graph.add('crop', 'crop=1920:800:0:140')
+    >>> str(graph)
+    'crop=1920:800:0:140,scale=1280:-2'
+    """
+
+    STAGES = ['hwdownload', 'crop', 'filter', 'scale', 'aspect', 'hwupload']
+
+    def __init__(self):
+        self.stages = dict((stage, []) for stage in self.STAGES)
+
+    def _filters(self, filters):
+        result = []
+        for f in filters:
+            if isinstance(f, Filter):
+                result.append(f)
+            elif f:
+                result.extend(Filter.parse(str(f)))
+        return result
+
+    def add(self, stage, *filters):
+        """
+        Append filters, either Filter objects or chain strings, to a stage.
+        """
+        self.stages[stage].extend(self._filters(filters))
+
+    def insert(self, stage, *filters):
+        """
+        Put filters at the start of a stage.
+        """
+        self.stages[stage][0:0] = self._filters(filters)
+
+    @property
+    def filters(self):
+        return [f for stage in self.STAGES for f in self.stages[stage]]
+
+    def __len__(self):
+        return len(self.filters)
+
+    def __str__(self):
+        return ','.join(str(f) for f in self.filters)
+
+    def __repr__(self):
+        return 'FilterGraph(%s)' % str(self)
+
+    @staticmethod
+    def split(stream, graphs):
+        """
+        Combine the graphs of several outputs reading the same input stream
+        into one -filter_complex graph. Filters every output starts with
+        are applied once ahead of a split. Returns the graph along with the
+        labelled output pad of each output, in order.
+
+        >>> FilterGraph.split('0:0', [graph1080, graph720])
+        ('[0:0]crop=1920:800:0:140,split=2[s0][s1];[s0]null[v0];[s1]scale=1280:-2[v1]', ['[v0]', '[v1]'])
+        """
+        chains = [g.filters for g in graphs]
+        shared = []
+        if len(chains) > 1:
+            for nodes in zip(*chains):
+                if len(set(nodes)) != 1:
+                    break
+                shared.append(nodes[0])
+
+        labels = ['[v%d]' % i for i in range(len(chains))]
+        if len(chains) > 1:
+            pads = ['[s%d]' % i for i in range(len(chains))]
+            graph = ['[%s]%s%s' % (stream, ','.join(str(f) for f in shared + [Filter('split', len(chains))]), ''.join(pads))]
+            for pad, chain, label in zip(pads, chains, labels):
+                graph.append('%s%s%s' % (pad, ','.join(str(f) for f in chain[len(shared):]) or 'null', label))
+        else:
+            graph = ['[%s]%s%s' % (stream, ','.join(str(f) for f in chains[0]) or 'null', labels[0])]
+        return ';'.join(graph), labels
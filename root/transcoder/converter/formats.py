@@ -5,7 +5,7 @@ class BaseFormat(object):
     """
     Base format class.
 
-    Supported formats are: ogg, avi, mkv, webm, flv, mov, mp4, mpeg
+    Supported formats are: ogg, avi, mkv, webm, flv, mov, mp4, hls, mpeg
     """
 
     format_name = None
@@ -76,6 +76,27 @@ class Mp4Format(BaseFormat):
     ffmpeg_format_name = 'mp4'
 
 
+class HlsFormat(BaseFormat):
+    """
+    HLS media playlist with CMAF (fragmented mp4) segments. The segment
+    duration, init segment name and segment file pattern are taken from
+    the segment-duration, init-filename and segment-filename options.
+    """
+    format_name = 'hls'
+    ffmpeg_format_name = 'hls'
+
+    def parse_options(self, opt):
+        optlist = super(HlsFormat, self).parse_options(opt)
+        optlist.extend(['-hls_segment_type', 'fmp4', '-hls_playlist_type', 'vod', '-hls_flags', 'independent_segments'])
+        if opt.get('segment-duration'):
+            optlist.extend(['-hls_time', '%.3f' % opt['segment-duration']])
+        if opt.get('init-filename'):
+            optlist.extend(['-hls_fmp4_init_filename', opt['init-filename']])
+        if opt.get('segment-filename'):
+            optlist.extend(['-hls_segment_filename', opt['segment-filename']])
+        return optlist
+
+
 class MpegFormat(BaseFormat):
     """
     MPEG(TS) container, used mainly for MPEG 1/2 video codecs.
@@ -126,6 +147,6 @@ class SsaFormat(BaseFormat):
 
 format_list = [
     OggFormat, AviFormat, MkvFormat, WebmFormat, FlvFormat,
-    MovFormat, Mp4Format, MpegFormat, Mp3Format, SrtFormat,
+    MovFormat, Mp4Format, HlsFormat, MpegFormat, Mp3Format, SrtFormat,
     WebVTTFormat, SsaFormat, PGSFormat
 ]
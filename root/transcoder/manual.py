@@ -9,8 +9,10 @@ import argparse
 import struct
 import enum
 import logging
-import shutil
+import threading
+import queue
 import tmdbsimple as tmdb
+from concurrent.futures import ThreadPoolExecutor
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
 from resources.mediaprocessor import MediaProcessor
@@ -238,96 +240,89 @@ def processFile(inputFile, mp, info=None, relativePath=None, silent=False, tag=T
 
     outputFiles = []
 
-    # Determine original resolution
-    width = info.video.video_width
-    height = info.video.video_height
-    if width / height > 1.4:
-        if width > 6500: res = 4320
-        elif 3501 <= width <= 6500: res = 2160
-        elif 2001 <= width <= 3500: res = 1440
-        elif 1801 <= width <= 2000: res = 1080
-        elif 1001 <= width <= 1800: res = 720
-        elif 701 <= width <= 1000: res = 480
-        elif 451 <= width <= 700: res = 360
-        else: res = 240
+    # Plan the resolution ladder for this source
+    plan = mp.planLadder(inputFile, info)
+
+    origInputFile = inputFile
+    # An unfinished job keeps its source and job manifest so it can be resumed
+    finished = True
+    if mp.settings.ladderoutput == 'hls':
+        # The whole ladder goes into a single package directory, its segments are not tagged or run through QTFS
+        packageDir = mp.processPackage(inputFile, plan, True, info=info, original=original)
+        finished = bool(packageDir)
+        if packageDir:
+            mp.processTrickplay(os.path.join(packageDir, 'master.m3u8'), packageDir)
+            outputFiles += mp.moveFile(packageDir)
+        else:
+            log.error("There was an error packaging file %s, no output data received" % inputFile)
     else:
-        if height > 4000: res = 4320
-        elif 2001 <= height <= 4000: res = 2160
-        elif 1301 <= height <= 2000: res = 1440
-        elif 951 <= height <= 1300: res = 1080
-        elif 651 <= height <= 950: res = 720
-        elif 451 <= height <= 650: res = 480
-        elif 300 <= height <= 450: res = 360
-        else: res = 240
-
-    resolutions = [i for i in [4320, 2160, 1440, 1080, 720, 480, 360, 240] if i <= res]
-
-    first = True
-    for resolution in resolutions:
-        output = mp.process(inputFile, True, info=info, original=original, resolution=resolution)
-
-        if output:
-            language = 'eng' or mp.getDefaultAudioLanguage(output["options"]) or None
-            log.debug("Tag language setting is %s, using language %s for tagging." % ('eng' or None, language))
+        # Encode the whole ladder up front so streams common to every rung are only encoded once
+        ladder = None
+        if len(plan) > 1:
+            ladder = mp.processLadder(inputFile, plan, True, info=info, original=original)
+            # Finished rungs of an unfinished ladder stay untagged where they were encoded so the job manifest still recognises them
+            if len(ladder) < len(plan):
+                log.error("%d of %d rungs of %s were encoded, keeping them and the source to resume from." % (len(ladder), len(plan), inputFile))
+                return False
+
+        for rung in plan:
+            resolution = rung.resolution
+            output = ladder.get(resolution) if ladder is not None else mp.process(inputFile, True, info=info, original=original, resolution=resolution, rung=rung, last=rung is plan[-1])
+
+            if output:
+                language = 'eng' or mp.getDefaultAudioLanguage(output["options"]) or None
+                log.debug("Tag language setting is %s, using language %s for tagging." % ('eng' or None, language))
             
-            tagData = getInfo(inputFile, silent, tag=tag, tmdbId=tmdbId, tvdbId=tvdbId, imdbId=imdbId, season=season, episode=episode, language=language, original=original)
-            if not tagData:
-                log.info("Processing file %s" % inputFile)
-            elif tagData.mediatype == MediaType.Movie:
-                log.info("Processing %s" % (tagData.title))
-            elif tagData.mediatype == MediaType.TV:
-                log.info("Processing %s Season %02d Episode %02d - %s" % (tagData.showname, int(tagData.season), int(tagData.episode), tagData.title))
-
-            # Tag with metadata
-            tagFailed = False
-            if tagData:
-                try:
-                    tagData.writeTags(output['output'], mp.converter, True, False, width=output['x'], height=output['y'])
-                except:
-                    log.exception("There was an error tagging the file")
-                    tagFailed = True
-
-            # QTFS
-            if not tagFailed:
-                mp.QTFS(output['output'])
-
-            # Permissions
-            mp.setPermissions(output['output'])
-
-            # Complete initial file
-            if first == True:
-                origInputFile = inputFile
-                inputFile = str(output['output']).replace('.mp4', '-copy.mp4')
-                shutil.copy(output['output'], inputFile)
-                log.debug("%s copied to %s." % (output['output'], inputFile))
-                info = mp.isValidSource(inputFile)
-                first = False
+                tagData = getInfo(inputFile, silent, tag=tag, tmdbId=tmdbId, tvdbId=tvdbId, imdbId=imdbId, season=season, episode=episode, language=language, original=original)
+                if not tagData:
+                    log.info("Processing file %s" % inputFile)
+                elif tagData.mediatype == MediaType.Movie:
+                    log.info("Processing %s" % (tagData.title))
+                elif tagData.mediatype == MediaType.TV:
+                    log.info("Processing %s Season %02d Episode %02d - %s" % (tagData.showname, int(tagData.season), int(tagData.episode), tagData.title))
+
+                # Tag with metadata
+                tagFailed = False
+                if tagData:
+                    try:
+                        tagData.writeTags(output['output'], mp.converter, True, False, width=output['x'], height=output['y'])
+                    except:
+                        log.exception("There was an error tagging the file")
+                        tagFailed = True
+
+                # QTFS
+                if not tagFailed:
+                    mp.QTFS(output['output'])
+
+                # Permissions
+                mp.setPermissions(output['output'])
+
+                # Lower rungs keep reading the source directly, which may have been renamed aside if an output took its name
+                if not output['inputDeleted']:
+                    inputFile = output['input']
 
                 # Reverse Ouput
                 output['output'] = mp.restoreFromOutput(origInputFile, output['output'], resolution=resolution)
-            else:
-                # Reverse Ouput
-                output['output'] = mp.restoreFromOutput(inputFile, output['output'], resolution=resolution)
 
-            # Move file to correct location
-            outputFiles += mp.moveFile(output['output'])
-        else:
-            log.error("There was an error processing file %s, no output data received" % inputFile)
+                # Trickplay previews, moved alongside the output
+                trickplay = mp.processTrickplay(output['output'])
 
-    if os.path.isfile(origInputFile):
+                # Move file to correct location
+                outputFiles += mp.moveFile(output['output'])
+                if trickplay:
+                    outputFiles += mp.moveFile(trickplay)
+            else:
+                log.error("There was an error processing file %s, no output data received" % inputFile)
+
+    if not finished:
+        log.info("%s was not packaged, keeping it to resume from." % origInputFile)
+    elif os.path.isfile(origInputFile):
         log.debug("%s exists, deleting copied file." % (origInputFile))
         if mp.removeFile(origInputFile):
             log.debug("%s deleted." % origInputFile)
         else:
             log.error("Couldn't delete %s." % origInputFile)
 
-    if os.path.isfile(inputFile):
-        log.debug("%s exists, deleting copied file." % (inputFile))
-        if mp.removeFile(inputFile):
-            log.debug("%s deleted." % inputFile)
-        else:
-            log.error("Couldn't delete %s." % inputFile)
-
     for file in outputFiles:
         mp.setPermissions(file)
 
@@ -342,14 +337,84 @@ def processFile(inputFile, mp, info=None, relativePath=None, silent=False, tag=T
         postprocessor.run_scripts()
 
 
+# Yield every file below dir as it is found, without building the full listing first
+def scanDir(dir):
+    dirs = [dir]
+    while dirs:
+        current = dirs.pop()
+        try:
+            with os.scandir(current) as entries:
+                subdirs = []
+                for entry in entries:
+                    try:
+                        # Links to directories are skipped like os.walk does, they are neither descended into nor files
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                            continue
+                    except OSError:
+                        pass
+                    yield entry.path
+        except OSError:
+            log.exception("Unable to scan directory %s." % current)
+            continue
+        dirs.extend(reversed(subdirs))
+
+
+# Probe files found by scanDir on a bounded pool of workers, yielding (filepath, info) pairs in the order probes complete
+def probeDir(dir, mp, workers):
+    results = queue.Queue(maxsize=workers * 2)
+    slots = threading.BoundedSemaphore(workers * 2)
+    stop = threading.Event()
+    done = object()
+
+    def probe(filepath):
+        try:
+            if not stop.is_set():
+                try:
+                    info = mp.isValidSource(filepath)
+                except:
+                    log.exception("Unable to probe %s, skipping." % filepath)
+                    info = None
+                results.put((filepath, info))
+        finally:
+            slots.release()
+
+    def discover():
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for filepath in scanDir(dir):
+                    slots.acquire()
+                    if stop.is_set():
+                        slots.release()
+                        break
+                    executor.submit(probe, filepath)
+        except:
+            log.exception("Library scan of %s failed." % dir)
+        finally:
+            results.put(done)
+
+    discovery = threading.Thread(target=discover, name="scan", daemon=True)
+    discovery.start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                break
+            yield result
+    finally:
+        # Unblock the workers if processing stopped early so the scan winds down
+        stop.set()
+        while discovery.is_alive():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
 def walkDir(dir, silent=False, preserveRelative=False, tmdbId=None, imdbId=None, tvdbId=None, tag=True, optionsOnly=False):
-    files = []
     mp = MediaProcessor(settings, logger=log)
-    for r, d, f in os.walk(dir):
-        for file in f:
-            files.append(os.path.join(r, file))
-    for filepath in files:
-        info = mp.isValidSource(filepath)
+    for filepath, info in probeDir(dir, mp, settings.probeworkers):
         if info:
             log.info("Processing file %s" % (filepath))
             relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
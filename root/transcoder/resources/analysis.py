@@ -0,0 +1,244 @@
+import os
+import logging
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from converter import FFMpegConvertError, ConverterError
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Start times of samples spread evenly over a source and away from the very start and end
+def sampleTimes(duration, samples, sampleLength):
+    if duration <= samples * sampleLength:
+        return [0]
+    return [duration * (i + 0.5) / samples - sampleLength / 2.0 for i in range(samples)]
+
+
+# Estimates how hard a source is to compress by encoding short samples of it at a low resolution and fixed CRF
+class ComplexityAnalyzer:
+    width = 640
+    crf = 23
+    preset = 'ultrafast'
+
+    # Bits per pixel the sample encode produces for typical live action content, complexity 1.0
+    referenceBpp = 0.1
+
+    # Complexity is clamped so a misleading sample can't starve or bloat the whole ladder
+    minComplexity = 0.5
+    maxComplexity = 1.5
+
+    def __init__(self, converter, samples=6, sampleLength=10, threads=0, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.converter = converter
+        self.samples = samples
+        self.sampleLength = sampleLength
+        self.threads = threads
+
+    def sampleTimes(self, duration):
+        return sampleTimes(duration, self.samples, self.sampleLength)
+
+    # Encode a single sample, returning its size in bytes and the length encoded
+    def encodeSample(self, inputFile, info, start, outputFile):
+        length = min(self.sampleLength, info.format.duration - start)
+        options = {
+            'source': [inputFile],
+            'format': 'mp4',
+            'video': {
+                'codec': 'h264',
+                'map': info.video.index,
+                'width': min(self.width, info.video.video_width),
+                'crf': self.crf,
+                'preset': self.preset,
+                'pix_fmt': 'yuv420p'
+            },
+            'audio': [],
+            'subtitle': []
+        }
+        preopts = ['-hide_banner', '-ss', '%.3f' % start, '-t', '%.3f' % length]
+        postopts = ['-threads', str(self.threads), '-an', '-sn']
+        for _ in self.converter.convert(outputFile, options, timeout=None, preopts=preopts, postopts=postopts, strip_metadata=True, info=info):
+            pass
+        return os.path.getsize(outputFile), length
+
+    # Complexity of the source relative to typical content, None if it could not be measured. Cached with its probe as it feeds the
+    # rung bitrates a resumed job is matched against
+    def complexity(self, inputFile, info):
+        complexity = self.converter.get_result(inputFile, 'complexity')
+        if complexity is None:
+            complexity = self.measure(inputFile, info)
+            if complexity is not None:
+                self.converter.put_result(inputFile, 'complexity', complexity)
+        return complexity
+
+    def measure(self, inputFile, info):
+        if not info or not info.video or not info.format.duration:
+            return None
+
+        width = min(self.width, info.video.video_width)
+        height = width * info.video.video_height / info.video.video_width
+        fps = info.video.fps or 24.0
+
+        fd, outputFile = tempfile.mkstemp(prefix='mmt-analysis-', suffix='.mp4')
+        os.close(fd)
+        size = 0
+        duration = 0
+        try:
+            for start in self.sampleTimes(info.format.duration):
+                sampleSize, length = self.encodeSample(inputFile, info, start, outputFile)
+                size += sampleSize
+                duration += length
+        except (FFMpegConvertError, ConverterError):
+            self.log.exception("Complexity analysis of %s failed, using the default ladder bitrates." % inputFile)
+            return None
+        finally:
+            if os.path.exists(outputFile):
+                os.remove(outputFile)
+
+        if not duration:
+            return None
+
+        bpp = (size * 8.0 / duration) / (width * height * fps)
+        complexity = max(self.minComplexity, min(self.maxComplexity, bpp / self.referenceBpp))
+        self.log.info("Sampled %.0f seconds of %s at %.4f bits per pixel, complexity %.2f." % (duration, inputFile, bpp, complexity))
+        return complexity
+
+
+# Classifies a source as progressive, interlaced or telecined from its field order and idet over a few samples, so only sources that need it are deinterlaced
+class ScanAnalyzer:
+    filters = {
+        'progressive': None,
+        'interlaced': 'bwdif=mode=send_field:parity=auto:deint=all',
+        # Inverse telecine, rebuilding the original progressive frames and dropping the duplicates, any frame left combed is deinterlaced
+        'telecined': 'fieldmatch=order=auto:combmatch=full,bwdif=mode=send_frame:parity=auto:deint=interlaced,decimate',
+    }
+
+    # Share of frames idet must find interlaced before the source is deinterlaced
+    minInterlaced = 0.1
+    # Telecine shows up as repeated fields with a mix of interlaced and progressive frames
+    minRepeated = 0.1
+    maxTelecineInterlaced = 0.7
+
+    def __init__(self, converter, samples=4, frames=200, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.converter = converter
+        self.samples = samples
+        self.frames = frames
+
+    # Scan type of a source, cached with its probe
+    def scanType(self, inputFile, info):
+        scanType = self.converter.get_result(inputFile, 'scan-type')
+        if scanType not in self.filters:
+            scanType = self.detect(inputFile, info)
+            self.converter.put_result(inputFile, 'scan-type', scanType)
+        return scanType
+
+    def filter(self, inputFile, info):
+        return self.filters[self.scanType(inputFile, info)]
+
+    def detect(self, inputFile, info):
+        fieldOrder = info.video.field_order
+        if fieldOrder == 'progressive':
+            self.log.info("Source %s is flagged progressive, no deinterlacing needed." % inputFile)
+            return 'progressive'
+
+        fps = info.video.fps or 24.0
+        counts = {'tff': 0, 'bff': 0, 'progressive': 0, 'undetermined': 0, 'repeated': 0}
+        for start in sampleTimes(info.format.duration or 0, self.samples, self.frames / fps):
+            sample = self.converter.idet(inputFile, '%.3f' % start, self.frames)
+            if sample:
+                for k in counts:
+                    counts[k] += sample.get(k, 0)
+
+        interlaced = counts['tff'] + counts['bff']
+        total = interlaced + counts['progressive']
+        # Only a progressive flag or idet can show a source is progressive, anything undecided is deinterlaced to be safe
+        if not total:
+            self.log.info("Unable to detect interlacing of %s with field order %s, deinterlacing it." % (inputFile, fieldOrder))
+            return 'interlaced'
+
+        interlacedShare = float(interlaced) / total
+        repeatedShare = float(counts['repeated']) / total
+        if interlacedShare < self.minInterlaced:
+            scanType = 'progressive'
+        elif repeatedShare >= self.minRepeated and interlacedShare <= self.maxTelecineInterlaced:
+            scanType = 'telecined'
+        else:
+            scanType = 'interlaced'
+        self.log.info("Source %s with field order %s is %s, idet found %.0f%% interlaced frames and %.0f%% repeated fields." % (inputFile, fieldOrder, scanType, interlacedShare * 100, repeatedShare * 100))
+        return scanType
+
+
+# Finds black bars to crop by running cropdetect at seek points spread over the source and taking the consensus of the rectangles found
+class CropAnalyzer:
+    samples = 12
+    frames = 12
+    workers = 4
+
+    # Edges may wander this many pixels from the median and still agree with it
+    tolerance = 4
+    # Share of samples that must agree before cropping, dark scenes and changing aspect ratios are not cropped
+    minAgreement = 0.6
+    # Borders thinner than this share of the frame are not worth a crop
+    minCrop = 0.02
+
+    def __init__(self, converter, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.converter = converter
+
+    # Crop as a (width, height, x, y) rectangle, None if the source has no black bars, cached with its probe
+    def crop(self, inputFile, info):
+        crop = self.converter.get_result(inputFile, 'crop')
+        if crop is None:
+            crop = self.detect(inputFile, info) or []
+            self.converter.put_result(inputFile, 'crop', list(crop))
+        return tuple(crop) if crop else None
+
+    def detect(self, inputFile, info):
+        if not info or not info.video or not info.format.duration:
+            return None
+
+        width = info.video.video_width
+        height = info.video.video_height
+        times = sampleTimes(info.format.duration, self.samples, 0)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            rects = [x for x in executor.map(lambda t: self.converter.cropdetect(inputFile, '%.3f' % t, self.frames), times) if x]
+        if not rects:
+            self.log.info("Unable to detect black bars in %s." % inputFile)
+            return None
+
+        # Work with edges, the left, top, right and bottom of every rectangle
+        edges = [(x, y, x + w, y + h) for w, h, x, y in rects]
+        median, agreement = self.consensus(edges)
+        if agreement < self.minAgreement:
+            self.log.info("Black bars in %s differ between samples (%.0f%% agree), not cropping." % (inputFile, agreement * 100))
+            return None
+
+        left, top, right, bottom = [int(x) for x in median]
+        # Keep the picture centred on even coordinates as the encoders require
+        left += left % 2
+        top += top % 2
+        w = min(right, width) - left
+        h = min(bottom, height) - top
+        w -= w % 2
+        h -= h % 2
+        if w <= 0 or h <= 0 or (w > width * (1 - self.minCrop) and h > height * (1 - self.minCrop)):
+            self.log.info("No black bars worth cropping in %s." % inputFile)
+            return None
+
+        self.log.info("Cropping %s from %dx%d to %dx%d at %d,%d, %.0f%% of samples agree." % (inputFile, width, height, w, h, left, top, agreement * 100))
+        return w, h, left, top
+
+    # Median of every edge and the share of samples with all their edges close to it, with numpy when it is installed and the statistics module otherwise
+    def consensus(self, edges):
+        if numpy:
+            edges = numpy.array(edges)
+            median = numpy.median(edges, axis=0)
+            agreement = numpy.mean(numpy.all(numpy.abs(edges - median) <= self.tolerance, axis=1))
+            return median.tolist(), float(agreement)
+
+        median = [statistics.median(x) for x in zip(*edges)]
+        agreeing = [e for e in edges if all(abs(a - m) <= self.tolerance for a, m in zip(e, median))]
+        return median, float(len(agreeing)) / len(edges)
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+from converter import FFMpegConvertError, ConverterError
+from resources.analysis import sampleTimes
+
+
+# Encoding speed of x264 presets on this host in pixels per second per thread, measured with a short sample encode the first time a preset is needed and kept in a JSON file per host
+class SpeedModel:
+    presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+    width = 640
+    crf = 23
+    sampleLength = 5
+
+    def __init__(self, converter, path=None, threads=0, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.converter = converter
+        self.path = path
+        self.threads = threads or os.cpu_count() or 1
+        self.host = socket.gethostname()
+        self.rates = self.load().get(self.host, {})
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            self.log.exception("Unable to read encode speed model %s, presets will be measured again." % self.path)
+            return {}
+
+    def save(self):
+        if not self.path:
+            return
+        stored = self.load()
+        stored[self.host] = self.rates
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(stored, f, indent=4)
+            os.replace(self.path + '.tmp', self.path)
+        except (IOError, OSError):
+            self.log.exception("Unable to write encode speed model %s." % self.path)
+
+    # Pixels per second per thread for a preset, None if it could not be measured
+    def rate(self, preset, inputFile, info):
+        if preset not in self.rates:
+            rate = self.measure(preset, inputFile, info)
+            if not rate:
+                return None
+            self.rates[preset] = rate
+            self.save()
+        return self.rates[preset]
+
+    # Time a sample encode of the middle of the source, decoding is included as every real encode pays for it too
+    def measure(self, preset, inputFile, info):
+        if not info or not info.video or not info.format.duration:
+            return None
+
+        width = min(self.width, info.video.video_width)
+        width -= width % 2
+        height = width * info.video.video_height / info.video.video_width
+        fps = info.video.fps or 24.0
+        start = sampleTimes(info.format.duration, 1, self.sampleLength)[0]
+        length = min(self.sampleLength, info.format.duration - start)
+
+        options = {
+            'source': [inputFile],
+            'format': 'mp4',
+            'video': {
+                'codec': 'h264',
+                'map': info.video.index,
+                'width': width,
+                'crf': self.crf,
+                'preset': preset,
+                'pix_fmt': 'yuv420p'
+            },
+            'audio': [],
+            'subtitle': []
+        }
+        preopts = ['-hide_banner', '-ss', '%.3f' % start, '-t', '%.3f' % length]
+        postopts = ['-threads', str(self.threads), '-an', '-sn']
+
+        fd, outputFile = tempfile.mkstemp(prefix='mmt-speed-', suffix='.mp4')
+        os.close(fd)
+        try:
+            began = time.monotonic()
+            for _ in self.converter.convert(outputFile, options, timeout=None, preopts=preopts, postopts=postopts, strip_metadata=True, info=info):
+                pass
+            elapsed = time.monotonic() - began
+        except (FFMpegConvertError, ConverterError):
+            self.log.exception("Unable to measure the speed of preset %s." % preset)
+            return None
+        finally:
+            if os.path.exists(outputFile):
+                os.remove(outputFile)
+
+        if elapsed <= 0:
+            return None
+        rate = width * height * fps * length / elapsed / self.threads
+        self.log.info("Preset %s encodes %.0f pixels per second per thread on %s." % (preset, rate, self.host))
+        return rate
+
+
+class EncodeProfile:
+    def __init__(self, preset, tune=None, threads=None):
+        self.preset = preset
+        self.tune = tune
+        self.threads = threads
+
+    def __repr__(self):
+        return "<EncodeProfile preset=%s, tune=%s, threads=%s>" % (self.preset, self.tune, self.threads)
+
+
+# Picks the x264 preset and threads of every output so the whole ladder is encoded at a target realtime factor. Outputs start on the fastest preset and spare
+# threads go to the slower preset that costs the fewest extra threads, so small rungs get slow presets first as they cost little beside the large ones
+# Without a target every output keeps the fastest preset and the configured tune. Planned outputs drop zerolatency, which turns off the B-frames and lookahead
+# the sample encodes of the speed model were measured with, other tunes are kept
+class EncodeProfiler:
+    def __init__(self, speedModel, realtime=0, presets=None, tune=None, threads=0, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.speedModel = speedModel
+        self.realtime = realtime
+        self.presets = sorted([x for x in presets or ['veryfast'] if x in SpeedModel.presets], key=SpeedModel.presets.index) or ['veryfast']
+        self.tune = tune or None
+        self.threads = threads or os.cpu_count() or 1
+
+    # Profiles for outputs given as a dict of key to output width, None for the source width. Threads are only planned for outputs encoded at the same time
+    def plan(self, inputFile, info, outputs, concurrent=False):
+        fastest = dict((k, EncodeProfile(self.presets[0], self.tune)) for k in outputs)
+        if not self.realtime or len(self.presets) < 2 or not info or not info.video:
+            return fastest
+
+        rates = [self.speedModel.rate(x, inputFile, info) for x in self.presets]
+        presets = [x for x, rate in zip(self.presets, rates) if rate]
+        rates = [x for x in rates if x]
+        if not presets:
+            return fastest
+
+        # Threads an output needs to keep up with the target on each preset
+        fps = info.video.fps or 24.0
+        aspect = (1.0 * info.video.video_height) / info.video.video_width
+        need = {}
+        for k, width in outputs.items():
+            width = width or info.video.video_width
+            need[k] = [width * width * aspect * fps * self.realtime / rate for rate in rates]
+
+        choice = dict((k, 0) for k in outputs)
+        total = sum(x[0] for x in need.values())
+        if total > self.threads:
+            self.log.warning("%.1fx realtime needs %.1f threads on preset %s, more than the %d available [encode-realtime]." % (self.realtime, total, presets[0], self.threads))
+        while True:
+            steps = [(need[k][i + 1] - need[k][i], k) for k, i in choice.items() if i + 1 < len(presets)]
+            steps = [x for x in steps if total + x[0] <= self.threads]
+            if not steps:
+                break
+            cost, k = min(steps, key=lambda x: x[0])
+            choice[k] += 1
+            total += cost
+
+        tune = None if self.tune == 'zerolatency' else self.tune
+        profiles = {}
+        for k, i in choice.items():
+            threads = max(1, int(round(need[k][i] * self.threads / total))) if concurrent else None
+            profiles[k] = EncodeProfile(presets[i], tune, threads)
+        self.log.info("Encode profiles for %.1fx realtime using %.1f of %d threads: %s." % (self.realtime, total, self.threads, ", ".join("%s=%s" % (k, v.preset) for k, v in profiles.items())))
+        return profiles
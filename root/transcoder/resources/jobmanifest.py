@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import logging
+
+
+# On disk record of a ladder job (source fingerprint, planned rungs and finished rungs) so an interrupted job can pick up where it left off
+class JobManifest:
+    version = 1
+
+    def __init__(self, path, inputFile, plan, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.path = path
+        self.fingerprint = self.getFingerprint(inputFile)
+        self.plan = plan
+        self.started = {}
+        self.completed = {}
+
+    @staticmethod
+    def getFingerprint(inputFile):
+        stat = os.stat(inputFile)
+        return {'path': os.path.abspath(inputFile), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    # Digest of a rung's options, a rung only counts as finished if it was encoded with the same options
+    @staticmethod
+    def digest(options, postopts):
+        return hashlib.sha1(json.dumps([options, postopts], sort_keys=True).encode('utf-8')).hexdigest()
+
+    # Load a previous manifest for the same source, keeping rungs whose output is still intact and removing partial output
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except:
+            self.log.exception("Unable to read job manifest %s, starting over." % self.path)
+            return False
+
+        if data.get('version') != self.version or data.get('fingerprint') != self.fingerprint:
+            self.log.info("Job manifest %s belongs to a different source, starting over." % self.path)
+            for rung in data.get('completed', {}).values():
+                self.removeOutput(rung.get('output'))
+            for part in data.get('started', {}).values():
+                self.removeOutput(part)
+            return False
+
+        for resolution, rung in data.get('completed', {}).items():
+            output = rung.get('output')
+            if self.plan.get(resolution) != rung.get('digest'):
+                self.log.info("Options for %sp changed since it was encoded, encoding again." % resolution)
+                self.removeOutput(output)
+            elif not output or not os.path.isfile(output) or os.path.getsize(output) != rung.get('size'):
+                self.log.info("Output for %sp is missing or incomplete, encoding again." % resolution)
+            else:
+                self.log.info("Resuming job, %sp was already encoded to %s." % (resolution, output))
+                self.completed[resolution] = rung
+
+        # Partial mp4 output can't be appended to, so unfinished rungs start over
+        for resolution, part in data.get('started', {}).items():
+            if resolution not in self.completed:
+                self.log.debug("Removing partial output %s for %sp." % (part, resolution))
+                self.removeOutput(part)
+
+        self.save()
+        return True
+
+    def removeOutput(self, output):
+        try:
+            if output and os.path.isfile(output):
+                os.remove(output)
+        except:
+            self.log.exception("Unable to remove %s." % output)
+
+    def isComplete(self, resolution):
+        return str(resolution) in self.completed
+
+    def outputs(self):
+        return dict((int(k), v['output']) for k, v in self.completed.items())
+
+    def start(self, resolution, outputFile):
+        self.started[str(resolution)] = outputFile
+        self.save()
+
+    def complete(self, resolution, outputFile):
+        self.started.pop(str(resolution), None)
+        self.completed[str(resolution)] = {'output': outputFile, 'size': os.path.getsize(outputFile), 'digest': self.plan.get(str(resolution))}
+        self.save()
+
+    def save(self):
+        data = {
+            'version': self.version,
+            'fingerprint': self.fingerprint,
+            'plan': self.plan,
+            'started': self.started,
+            'completed': self.completed
+        }
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(data, f, indent=4)
+            os.replace(self.path + '.tmp', self.path)
+        except:
+            self.log.exception("Unable to write job manifest %s." % self.path)
+
+    def remove(self):
+        try:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+                self.log.debug("Job manifest %s removed." % self.path)
+        except:
+            self.log.exception("Unable to remove job manifest %s." % self.path)
@@ -0,0 +1,170 @@
+import logging
+from converter.ffmpeg import MediaStreamInfo
+
+
+class Rung:
+    def __init__(self, resolution, width, altwidth, bitrate, maxrate, bufsize, profile, level, pix_fmt, audiobitrate):
+        self.resolution = resolution
+        self.width = width
+        self.altwidth = altwidth
+        self.bitrate = bitrate
+        self.maxrate = maxrate
+        self.bufsize = bufsize
+        self.profile = profile
+        self.level = level
+        self.pix_fmt = pix_fmt
+        self.audiobitrate = audiobitrate
+
+    def __repr__(self):
+        return "<Rung %sp, bitrate=%s>" % (self.resolution, self.bitrate)
+
+    # Target width for sources wider than 1.4:1 (normal) or narrower (alternate)
+    def targetWidth(self, normal=True):
+        return self.width if normal else self.altwidth
+
+    # Copy of this rung with its video bitrate capped, scaling maxrate and bufsize to match since CRF encodes are only bounded by maxrate
+    def capped(self, bitrate):
+        bitrate = min(self.bitrate, bitrate)
+        ratio = (1.0 * bitrate) / self.bitrate
+        maxrate = "%dk" % (int(self.maxrate[:-1]) * ratio)
+        bufsize = "%dk" % (int(self.bufsize[:-1]) * ratio)
+        return Rung(self.resolution, self.width, self.altwidth, bitrate, maxrate, bufsize, self.profile, self.level, self.pix_fmt, self.audiobitrate)
+
+    # Copy of this rung with its video bitrate, maxrate and bufsize scaled by a per-title complexity factor
+    def scaled(self, factor):
+        bitrate = int(round(self.bitrate * factor))
+        maxrate = "%dk" % (int(self.maxrate[:-1]) * factor)
+        bufsize = "%dk" % (int(self.bufsize[:-1]) * factor)
+        return Rung(self.resolution, self.width, self.altwidth, bitrate, maxrate, bufsize, self.profile, self.level, self.pix_fmt, self.audiobitrate)
+
+
+class ResolutionLadder:
+    # Highest to lowest, bitrates in kbps
+    rungs = [
+        Rung(4320, 7680, 5760, 28600, '96640k', '144500k', 'high', 6.1, 'yuv420p10le', 512),
+        Rung(2160, 3840, 2880, 16100, '48512k', '72500k', 'high', 5.1, 'yuv420p10le', 512),
+        Rung(1440, 2560, 1920, 9000, '19968k', '29900k', 'high', 5.0, 'yuv420p10le', 384),
+        Rung(1080, 1920, 1440, 4900, '9856k', '14500k', 'high', 4.1, 'yuv420p', 256),
+        Rung(720, 1280, 960, 2850, '6336k', '9500k', 'high', 4.0, 'yuv420p', 192),
+        Rung(480, 854, 640, 1425, '3432k', '3500k', 'main', 3.1, 'yuv420p', 128),
+        Rung(360, 640, 480, 800, '928k', '1300k', 'baseline', 3.0, 'yuv420p', 96),
+        Rung(240, 426, 320, 500, '652k', '950k', 'baseline', 3.0, 'yuv420p', 64),
+    ]
+
+    # H.264 profiles in increasing order of decoder requirements
+    profiles = ['constrained baseline', 'baseline', 'main', 'high']
+
+    # Envelope of audio streams that are copied instead of encoded, bitrates may overshoot the target by a little as encoders never hit it exactly
+    audioProfiles = ['lc', 'he-aac', 'he-aacv2']
+    audioLayouts = {1: ['mono'], 2: ['stereo'], 6: ['5.1', '5.1(side)']}
+    minSampleRate = 44100
+    audioBitrateTolerance = 1.05
+
+    def __init__(self, minsavings=0.25, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.minsavings = minsavings
+
+    def rung(self, resolution):
+        return next((x for x in self.rungs if x.resolution == resolution), None)
+
+    @staticmethod
+    def isNormal(info):
+        return info.video.video_width / info.video.video_height > 1.4
+
+    # Classify the source into the rung it would be labelled as, by width for wide sources and by height otherwise
+    def sourceResolution(self, info):
+        width = info.video.video_width
+        height = info.video.video_height
+        if self.isNormal(info):
+            if width > 6500: return 4320
+            elif 3501 <= width <= 6500: return 2160
+            elif 2001 <= width <= 3500: return 1440
+            elif 1801 <= width <= 2000: return 1080
+            elif 1001 <= width <= 1800: return 720
+            elif 701 <= width <= 1000: return 480
+            elif 451 <= width <= 700: return 360
+            else: return 240
+        else:
+            if height > 4000: return 4320
+            elif 2001 <= height <= 4000: return 2160
+            elif 1301 <= height <= 2000: return 1440
+            elif 951 <= height <= 1300: return 1080
+            elif 651 <= height <= 950: return 720
+            elif 451 <= height <= 650: return 480
+            elif 300 <= height <= 450: return 360
+            else: return 240
+
+    # Video bitrate of the source in kbps, estimated from the container when the stream does not report one
+    def sourceBitrate(self, info):
+        if info.video.bitrate:
+            return info.video.bitrate / 1000
+        if info.format.bitrate:
+            audio = sum([x.bitrate or 0 for x in info.audio])
+            if info.format.bitrate > audio:
+                return (info.format.bitrate - audio) / 1000
+        return None
+
+    # Check the properties of the source video stream against a rung, returns the first reason it does not comply or None if it does
+    def nonCompliance(self, info, rung):
+        video = info.video
+        if video.codec != 'h264':
+            return "codec %s is not h264" % video.codec
+        if video.profile not in self.profiles or self.profiles.index(video.profile) > self.profiles.index(rung.profile):
+            return "profile %s exceeds %s" % (video.profile, rung.profile)
+        if not video.video_level or video.video_level > rung.level:
+            return "level %s exceeds %s" % (video.video_level, rung.level)
+        if video.pix_fmt != rung.pix_fmt:
+            return "pix_fmt %s is not %s" % (video.pix_fmt, rung.pix_fmt)
+        if video.video_width > rung.targetWidth(self.isNormal(info)):
+            return "width %d exceeds %d" % (video.video_width, rung.targetWidth(self.isNormal(info)))
+        if video.field_order not in [None, 'progressive']:
+            return "field order %s needs deinterlacing" % video.field_order
+        return None
+
+    # Check a source audio stream against the stream an output would encode from it, returns the first reason it can not be copied or None if it can
+    def audioNonCompliance(self, stream, channels, bitrate, samplerate):
+        if stream.codec != 'aac':
+            return "codec %s is not aac" % stream.codec
+        if stream.profile not in self.audioProfiles:
+            return "aac profile %s is not %s" % (stream.profile, " or ".join(self.audioProfiles))
+        if stream.audio_channels != channels:
+            return "%s channels instead of %d" % (stream.audio_channels, channels)
+        layouts = self.audioLayouts.get(channels)
+        if layouts and stream.audio_channel_layout and stream.audio_channel_layout not in layouts:
+            return "channel layout %s is not %s" % (stream.audio_channel_layout, " or ".join(layouts))
+        if not stream.audio_samplerate or not self.minSampleRate <= stream.audio_samplerate <= samplerate:
+            return "sample rate %s is outside %d-%d" % (stream.audio_samplerate, self.minSampleRate, samplerate)
+        sbitrate = stream.bitrate or MediaStreamInfo.parse_int(stream.metadata.get('bps') or stream.metadata.get('bps-eng'), None)
+        if not sbitrate:
+            return "bitrate unknown"
+        if sbitrate > bitrate * 1000 * self.audioBitrateTolerance:
+            return "bitrate %dk exceeds %dk" % (sbitrate / 1000, bitrate)
+        return None
+
+    # Rungs worth encoding for a source, highest first, with bitrates scaled by the per-title complexity when one was measured
+    def plan(self, info, complexity=None):
+        res = self.sourceResolution(info)
+        sbitrate = self.sourceBitrate(info)
+        self.log.debug("Source classified as %sp with video bitrate %s." % (res, sbitrate))
+
+        plan = []
+        for rung in [x for x in self.rungs if x.resolution <= res]:
+            if complexity:
+                rung = rung.scaled(complexity)
+
+            # The top rung is always encoded but never at more than the source bitrate
+            if not plan:
+                if sbitrate and sbitrate < rung.bitrate:
+                    self.log.info("Capping %sp bitrate at source bitrate %d." % (rung.resolution, sbitrate))
+                    rung = rung.capped(int(sbitrate))
+                plan.append(rung)
+                continue
+
+            reference = plan[-1].bitrate
+            if self.minsavings and rung.bitrate > reference * (1 - self.minsavings):
+                self.log.info("Skipping %sp, %d kbps is not meaningfully below %sp at %d kbps [ladder-min-savings]." % (rung.resolution, rung.bitrate, plan[-1].resolution, reference))
+                continue
+            plan.append(rung)
+
+        self.log.info("Ladder plan: %s." % ", ".join(["%sp@%dk" % (x.resolution, x.bitrate) for x in plan]))
+        return plan
@@ -6,10 +6,20 @@ import sys
 import shutil
 import logging
 import re
-from converter import Converter, FFMpegConvertError, ConverterError
+import math
+from collections import OrderedDict, Counter
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from converter import Converter, FFMpegConvertError, ConverterError, ProgressEvent, ProbeCache
 from converter.avcodecs import BaseCodec
 from resources.extensions import subtitleCodecExtensions
 from resources.metadata import Metadata
+from resources.ladder import ResolutionLadder
+from resources.analysis import ComplexityAnalyzer, ScanAnalyzer, CropAnalyzer
+from resources.encodeprofile import SpeedModel, EncodeProfiler
+from resources.jobmanifest import JobManifest
+from resources.packager import Packager
+from resources.trickplay import Trickplay
 from resources.postprocess import PostProcessor
 from resources.lang import getAlpha3TCode
 from autoprocess import plex
@@ -29,11 +39,22 @@ except:
 
 class MediaProcessor:
     deleteSubs = set()
+    chunkThreads = 4
+    chunkMinLength = 30
+    # Stream titles read by pymediainfo, keyed by file identity, most recently used last
+    mediaInfoTitles = OrderedDict()
+    mediaInfoTitlesSize = 128
 
     def __init__(self, settings, logger=None):
         self.log = logger or logging.getLogger(__name__)
         self.settings = settings
-        self.converter = Converter(settings.ffmpeg, settings.ffprobe)
+        self.converter = Converter(settings.ffmpeg, settings.ffprobe, ProbeCache(path=settings.probecache), settings.capabilitiesfile)
+        self.ladder = ResolutionLadder(settings.ladderminsavings, self.log)
+        self.analyzer = ComplexityAnalyzer(self.converter, settings.analysissamples, threads=settings.threads, logger=self.log)
+        self.scanAnalyzer = ScanAnalyzer(self.converter, logger=self.log)
+        self.cropAnalyzer = CropAnalyzer(self.converter, logger=self.log)
+        self.profiler = EncodeProfiler(SpeedModel(self.converter, settings.speedmodelfile, settings.threads, logger=self.log), settings.encoderealtime, settings.encodepresets, settings.encodetune, settings.threads, logger=self.log)
+        self.trickplay = Trickplay(self.converter, settings.trickplay, settings.trickplayinterval, settings.trickplaywidth, logger=self.log)
 
     def fullprocess(self, inputFile, mediatype, reportProgress=False, original=None, info=None, tmdbId=None, tvdbId=None, imdbId=None, season=None, episode=None, language=None):
         try:
@@ -42,94 +63,97 @@ class MediaProcessor:
                 self.log.info("Processing %s." % inputFile)
                 outputFiles = []
 
-                # Determine original resolution
-                width = info.video.video_width
-                height = info.video.video_height
-                if width / height > 1.4:
-                    if width > 6500: res = 4320
-                    elif 3501 <= width <= 6500: res = 2160
-                    elif 2001 <= width <= 3500: res = 1440
-                    elif 1801 <= width <= 2000: res = 1080
-                    elif 1001 <= width <= 1800: res = 720
-                    elif 701 <= width <= 1000: res = 480
-                    elif 451 <= width <= 700: res = 360
-                    else: res = 240
-                else:
-                    if height > 4000: res = 4320
-                    elif 2001 <= height <= 4000: res = 2160
-                    elif 1301 <= height <= 2000: res = 1440
-                    elif 951 <= height <= 1300: res = 1080
-                    elif 651 <= height <= 950: res = 720
-                    elif 451 <= height <= 650: res = 480
-                    elif 300 <= height <= 450: res = 360
-                    else: res = 240
-
-                resolutions = [i for i in [4320, 2160, 1440, 1080, 720, 480, 360, 240] if i <= res]
-
-                first = True
-                for resolution in resolutions:
-                    if self.settings.multibitrate == True or first == True:
-                        output = self.process(inputFile, original=original, info=info, resolution=resolution)
-
-                        if output:
-                            if not language:
-                                language = 'eng' or self.getDefaultAudioLanguage(output['options']) or None
-                            self.log.debug("Tag language setting is %s, using language %s for tagging." % ('eng' or None, language))
-                            # Tag with metadata
-                            tagFailed = False
+                # Plan the resolution ladder for this source
+                plan = self.planLadder(inputFile, info)
+
+                origInputFile = inputFile
+                # An unfinished job keeps its source and job manifest so it can be resumed
+                finished = True
+                if self.settings.ladderoutput == 'hls':
+                    # The whole ladder goes into a single package directory, its segments are not tagged or run through QTFS
+                    packageDir = self.processPackage(inputFile, plan if self.settings.multibitrate else plan[:1], original=original, info=info)
+                    finished = bool(packageDir)
+                    if packageDir:
+                        self.processTrickplay(os.path.join(packageDir, 'master.m3u8'), packageDir)
+                        outputFiles += self.moveFile(packageDir)
+
+                        # Refresh Plex
+                        if self.settings.Plex.get('refresh', False):
                             try:
-                                tag = Metadata(mediatype, tvdbId=tvdbId, tmdbId=tmdbId, imdbId=imdbId, season=season, episode=episode, original=original, language=language)
-                                tmdbId = tag.tmdbId
-                                self.log.info("Tagging %s with TMDB ID %s." % (output['output'], tag.tmdbId))
-                                tag.writeTags(output['output'], self.converter, True, False, output['x'], output['y'])
+                                plex.refreshPlex(self.settings, mediatype, self.log)
                             except:
-                                self.log.exception("Unable to tag file")
-                                tagFailed = True
-
-                            # QTFS
-                            if not tagFailed:
-                                self.QTFS(output['output'])
-
-                            # Permissions
-                            self.setPermissions(output['output'])
-
-                            # Complete initial file
-                            if first == True:
-                                origInputFile = inputFile
-                                inputFile = str(output['output']).replace('.mp4', '-copy.mp4')
-                                shutil.copy(output['output'], inputFile)
-                                self.log.debug("%s copied to %s." % (output['output'], inputFile))
-                                info = self.isValidSource(inputFile)
+                                self.log.exception("Error refreshing Plex.")
+                else:
+                    # Encode the whole ladder up front so streams common to every rung are only encoded once
+                    ladder = None
+                    if self.settings.multibitrate and len(plan) > 1:
+                        ladder = self.processLadder(inputFile, plan, original=original, info=info)
+                        # Finished rungs of an unfinished ladder stay untagged where they were encoded so the job manifest still recognises them
+                        if len(ladder) < len(plan):
+                            self.log.error("%d of %d rungs of %s were encoded, keeping them and the source to resume from." % (len(ladder), len(plan), inputFile))
+                            return False
+
+                    first = True
+                    for rung in plan:
+                        resolution = rung.resolution
+                        if self.settings.multibitrate == True or first == True:
+                            output = ladder.get(resolution) if ladder is not None else self.process(inputFile, original=original, info=info, resolution=resolution, rung=rung, last=rung is plan[-1])
+
+                            if output:
+                                if not language:
+                                    language = 'eng' or self.getDefaultAudioLanguage(output['options']) or None
+                                self.log.debug("Tag language setting is %s, using language %s for tagging." % ('eng' or None, language))
+                                # Tag with metadata
+                                tagFailed = False
+                                try:
+                                    tag = Metadata(mediatype, tvdbId=tvdbId, tmdbId=tmdbId, imdbId=imdbId, season=season, episode=episode, original=original, language=language)
+                                    tmdbId = tag.tmdbId
+                                    self.log.info("Tagging %s with TMDB ID %s." % (output['output'], tag.tmdbId))
+                                    tag.writeTags(output['output'], self.converter, True, False, output['x'], output['y'])
+                                except:
+                                    self.log.exception("Unable to tag file")
+                                    tagFailed = True
+
+                                # QTFS
+                                if not tagFailed:
+                                    self.QTFS(output['output'])
+
+                                # Permissions
+                                self.setPermissions(output['output'])
+
+                                # Lower rungs keep reading the source directly, which may have been renamed aside if an output took its name
+                                if not output['inputDeleted']:
+                                    inputFile = output['input']
                                 first = False
 
-                            # Move to Radarr/Sonarr expected output dir
-                            if not self.settings.moveTo:
-                                output['output'] = self.restoreFromOutput(origInputFile, output['output'], resolution=resolution)
+                                # Move to Radarr/Sonarr expected output dir
+                                if not self.settings.moveTo:
+                                    output['output'] = self.restoreFromOutput(origInputFile, output['output'], resolution=resolution)
 
-                            # Move file to correct location
-                            outputFiles += self.moveFile(output['output'])
+                                # Trickplay previews, moved alongside the output
+                                trickplay = self.processTrickplay(output['output'])
 
-                            # Refresh Plex
-                            if self.settings.Plex.get('refresh', False):
-                                try:
-                                    plex.refreshPlex(self.settings, mediatype, self.log)
-                                except:
-                                    self.log.exception("Error refreshing Plex.")
+                                # Move file to correct location
+                                outputFiles += self.moveFile(output['output'])
+                                if trickplay:
+                                    outputFiles += self.moveFile(trickplay)
 
-                if os.path.isfile(origInputFile) and '.mp4' not in origInputFile:
+                                # Refresh Plex
+                                if self.settings.Plex.get('refresh', False):
+                                    try:
+                                        plex.refreshPlex(self.settings, mediatype, self.log)
+                                    except:
+                                        self.log.exception("Error refreshing Plex.")
+
+                if not finished:
+                    self.log.info("%s was not packaged, keeping it to resume from." % origInputFile)
+                elif os.path.isfile(origInputFile) and '.mp4' not in origInputFile:
                     self.log.debug("%s exists, deleting copied file." % (origInputFile))
                     if self.removeFile(origInputFile):
                         self.log.debug("%s deleted." % origInputFile)
                     else:
                         self.log.error("Couldn't delete %s." % origInputFile)
 
-                if os.path.isfile(inputFile):
-                    self.log.debug("%s exists, deleting copied file." % (inputFile))
-                    if self.removeFile(inputFile):
-                        self.log.debug("%s deleted." % inputFile)
-                    else:
-                        self.log.error("Couldn't delete %s." % inputFile)
-
                 # Run any post process scripts
                 if self.settings.postprocess:
                     postprocessor = PostProcessor(outputFiles, self.log, wait=self.settings.waitpostprocess)
@@ -143,11 +167,23 @@ class MediaProcessor:
             self.log.exception("Error processing")
         return False
 
+    # Build trickplay previews from the keyframes of an output so media servers don't have to decode it again [trickplay]
+    def processTrickplay(self, outputFile, outputDir=None):
+        if not self.settings.trickplay:
+            return None
+        return self.trickplay.generate(outputFile, self.converter.probe(outputFile), outputDir)
+
+    # Plan the resolution ladder for a source, scaling its bitrates by a quick complexity pre-pass when per-title bitrates are enabled
+    def planLadder(self, inputFile, info):
+        complexity = self.analyzer.complexity(inputFile, info) if self.settings.pertitle else None
+        return self.ladder.plan(info, complexity)
+
     # Process a file from start to finish, with checking to make sure formats are compatible with selected settings
-    def process(self, inputFile, reportProgress=False, original=None, info=None, progressOutput=None, resolution=None):
+    def process(self, inputFile, reportProgress=False, original=None, info=None, progressOutput=None, resolution=None, rung=None, last=True):
         self.log.debug("Process started.")
 
-        delete = self.settings.delete if resolution == None or resolution == 240 else False
+        # Only the last rung of a ladder may remove the source
+        delete = self.settings.delete if last else False
         deleted = False
         options = None
         preopts = None
@@ -160,7 +196,7 @@ class MediaProcessor:
 
         if info:
             try:
-                options, preopts, postopts, ripSubOpts, downloadedSubs = self.generateOptions(inputFile, info=info, original=original, resolution=resolution)
+                options, preopts, postopts, ripSubOpts, downloadedSubs = self.generateOptions(inputFile, info=info, original=original, resolution=resolution, rung=rung)
             except:
                 self.log.exception("Unable to generate options, unexpected exception occurred.")
                 return None
@@ -181,9 +217,11 @@ class MediaProcessor:
             except:
                 self.log.exception("Unable to log options.")
 
+            self.audioPassthroughReport([(resolution, options, postopts)])
+
             rippedSubs = self.ripSubs(inputFile, ripSubOpts)
             try:
-                outputFile, inputFile = self.convert(options, preopts, postopts, reportProgress, progressOutput, resolution=resolution)
+                outputFile, inputFile = self.convert(options, preopts, postopts, reportProgress, progressOutput, resolution=resolution, info=info)
             except:
                 self.log.exception("Unexpected exception encountered during conversion")
                 return None
@@ -239,6 +277,137 @@ class MediaProcessor:
                     'y': dim['y']}
         return None
 
+    # Process every rung of a resolution ladder, either from a single decode of the source file or as concurrent encodes
+    def processLadder(self, inputFile, plan, reportProgress=False, original=None, info=None, progressOutput=None, packageDir=None):
+        self.log.debug("Ladder process started.")
+
+        outputs = {}
+        rungs = []
+        preopts = None
+        ripSubOpts = []
+        downloadedSubs = []
+
+        info = info or self.isValidSource(inputFile)
+
+        if not info:
+            return outputs
+
+        # Rungs encoded side by side split the threads of the host between them, sequential rungs each get them all
+        normal = self.ladder.isNormal(info)
+        profiles = self.profiler.plan(inputFile, info, dict((x.resolution, x.targetWidth(normal)) for x in plan), concurrent=self.settings.laddermode != 'sequential')
+
+        for rung in plan:
+            resolution = rung.resolution
+            try:
+                options, rungPreopts, postopts, rungRipSubOpts, rungDownloadedSubs = self.generateOptions(inputFile, info=info, original=original, resolution=resolution, rung=rung, profile=profiles[resolution])
+            except:
+                self.log.exception("Unable to generate options for %sp, unexpected exception occurred." % resolution)
+                return outputs
+            if not options:
+                self.log.error("Error converting, inputFile %s had a valid extension but returned no data. Either the file does not exist, was unreadable, or was an incorrect format." % inputFile)
+                return outputs
+
+            if packageDir:
+                self.packageOptions(options, postopts, resolution, packageDir, info)
+
+            # Hardware acceleration, subtitle rips and downloads are identical for every rung
+            if preopts is None:
+                preopts = rungPreopts
+                ripSubOpts = rungRipSubOpts
+                downloadedSubs = rungDownloadedSubs
+
+            try:
+                self.log.info("Output Data %sp" % resolution)
+                self.log.info(json.dumps(options, sort_keys=False, indent=4))
+                self.log.info("Postopts %sp" % resolution)
+                self.log.info(json.dumps(postopts, sort_keys=False, indent=4))
+            except:
+                self.log.exception("Unable to log options.")
+
+            rungs.append((resolution, options, postopts))
+
+        try:
+            self.log.info("Preopts")
+            self.log.info(json.dumps(preopts, sort_keys=False, indent=4))
+            self.log.info("Downloaded Subtitles")
+            self.log.info(json.dumps(downloadedSubs, sort_keys=False, indent=4))
+        except:
+            self.log.exception("Unable to log options.")
+
+        # Before shared streams replace the audio of every rung with copies
+        self.audioPassthroughReport(rungs)
+
+        # Pick up an interrupted job for this source where it left off
+        manifest = JobManifest(self.getManifestFile(inputFile), inputFile, dict((str(x[0]), JobManifest.digest(x[1], x[2])) for x in rungs), self.log)
+        manifest.load()
+        pendingRungs = [x for x in rungs if not manifest.isComplete(x[0])]
+
+        rippedSubs = self.ripSubs(inputFile, ripSubOpts)
+        outputFiles = manifest.outputs()
+        if pendingRungs:
+            sharedFiles = self.shareStreams(pendingRungs, preopts, info)
+            try:
+                if self.settings.laddermode == 'parallel':
+                    outputFiles.update(self.convertParallel(pendingRungs, preopts, info, manifest, profiles))
+                elif self.settings.laddermode == 'single-decode':
+                    outputFiles.update(self.convertLadder(pendingRungs, preopts, reportProgress, progressOutput, info, manifest))
+                else:
+                    outputFiles.update(self.convertSequential(pendingRungs, preopts, reportProgress, progressOutput, info, manifest))
+            except:
+                self.log.exception("Unexpected exception encountered during ladder conversion")
+                return outputs
+            finally:
+                for sharedFile in sharedFiles:
+                    if self.removeFile(sharedFile):
+                        self.log.debug("Shared stream file %s deleted." % sharedFile)
+
+        if not outputFiles:
+            self.log.debug("Error converting, no outputFiles generated for inputFile %s." % inputFile)
+            return outputs
+
+        # Keep the manifest and the source around until every rung is done so the job can be resumed
+        finished = len(outputFiles) == len(rungs)
+        if finished:
+            manifest.remove()
+        else:
+            self.log.error("Only %d of %d rungs were encoded, keeping job manifest %s to resume from." % (len(outputFiles), len(rungs), manifest.path))
+
+        deleted = False
+        if self.settings.delete and finished:
+            self.log.debug("Attempting to remove %s." % inputFile)
+            if self.removeFile(inputFile):
+                self.log.debug("%s deleted." % inputFile)
+                deleted = True
+            else:
+                self.log.error("Couldn't delete %s." % inputFile)
+
+            for subfile in self.deleteSubs:
+                self.log.debug("Attempting to remove subtitle %s." % subfile)
+                if self.removeFile(subfile):
+                    self.log.debug("Subtitle %s deleted." % subfile)
+                else:
+                    self.log.debug("Unable to delete subtitle %s." % subfile)
+            self.deleteSubs = set()
+
+        inputExtension = self.parseFile(inputFile)[2]
+        for resolution, options, postopts in rungs:
+            outputFile = outputFiles.get(resolution)
+            if not outputFile:
+                continue
+            dim = self.getDimensions(outputFile)
+            outputs[resolution] = {'input': inputFile,
+                                   'inputExtension': inputExtension,
+                                   'inputDeleted': deleted,
+                                   'output': outputFile,
+                                   'outputExtension': self.parseFile(outputFile)[2],
+                                   'options': options,
+                                   'preopts': preopts,
+                                   'postopts': postopts,
+                                   'external_subs': downloadedSubs + rippedSubs,
+                                   'x': dim['x'],
+                                   'y': dim['y']}
+        return outputs
+
     def videoStreamTitle(self, width=0, height=0, swidth=0, sheight=0):
         output = "Video"
 
@@ -318,17 +487,6 @@ class MediaProcessor:
             if not info.audio or len(info.audio) < 1:
                 self.log.debug("Invalid source, no audio stream detected.")
                 return None
-            if MediaInfo:
-                try:
-                    media_info = MediaInfo.parse(inputFile)
-                    for track in media_info.tracks:
-                        if track.title and track.streamorder is not None:
-                            so = int(track.streamorder)
-                            stream = info.streams[so]
-                            stream.metadata['title'] = track.title
-                except:
-                    self.log.exception("Pymediainfo exception.")
-                    pass
             return info
         except:
             self.log.exception("isValidSource unexpectedly threw an exception, returning None.")
@@ -423,8 +581,42 @@ class MediaProcessor:
             s.metadata['language'] = getAlpha3TCode(s.metadata.get('language'), 'eng')
         return awl, swl
 
+    # Fill in missing audio and subtitle titles from pymediainfo, which parses the whole file
+    def mediaInfoTitleCheck(self, info):
+        if not MediaInfo or not info or not info.path or all(stream.metadata.get('title') for stream in info.audio + info.subtitle):
+            return
+
+        try:
+            key = ProbeCache.key(info.path)
+        except OSError:
+            return
+
+        titles = self.mediaInfoTitles.get(key)
+        if titles is None:
+            try:
+                start = time.time()
+                media_info = MediaInfo.parse(info.path)
+                titles = {}
+                for track in media_info.tracks:
+                    if track.title and track.streamorder is not None:
+                        titles[int(track.streamorder)] = track.title
+                self.log.info("Pymediainfo parsed %s in %.2f seconds." % (info.path, time.time() - start))
+            except:
+                self.log.exception("Pymediainfo exception.")
+                return
+            self.mediaInfoTitles[key] = titles
+            while len(self.mediaInfoTitles) > self.mediaInfoTitlesSize:
+                self.mediaInfoTitles.popitem(last=False)
+        else:
+            self.mediaInfoTitles.move_to_end(key)
+
+        for so, title in titles.items():
+            if so < len(info.streams) and info.streams[so].type in ['audio', 'subtitle'] and not info.streams[so].metadata.get('title'):
+                info.streams[so].metadata['title'] = title
+
     # Check and see if clues about the disposition are in the title
     def titleDispositionCheck(self, info):
+        self.mediaInfoTitleCheck(info)
         for stream in info.streams:
             title = stream.metadata.get('title', '').lower()
             if 'comment' in title:
@@ -441,7 +633,7 @@ class MediaProcessor:
                 stream.disposition['forced'] = True
 
     # Generate a dict of options to be passed to FFMPEG based on selected settings and the source file parameters and streams
-    def generateOptions(self, inputFile, info=None, original=None, resolution=None):
+    def generateOptions(self, inputFile, info=None, original=None, resolution=None, rung=None, profile=None):
         # Get path information from the input file
         sources = [inputFile]
         ripSubOpts = []
@@ -469,81 +661,25 @@ class MediaProcessor:
 
         vdebug = "video"
 
-        width = info.video.video_width
-        height = info.video.video_height
-        if width / height > 1.4:
-            normal = True
-        else:
-            normal = False
+        normal = self.ladder.isNormal(info)
         vcodec = "h264"
 
         vcrf = 22
-        vpreset = 'veryfast'
 
-        if resolution == 4320:
-            vwidth = 7680 if normal == True else 5760
-            vbitrate = 28600
-            vmaxrate = '96640k'
-            vbufsize = '144500k'
-            vprofile = 'high'
-            vpix_fmt = 'yuv420p10le'
-            audioBitrate = 512
-        elif resolution == 2160:
-            vwidth = 3840 if normal == True else 2880
-            vbitrate = 16100
-            vmaxrate = '48512k'
-            vbufsize = '72500k'
-            vprofile = 'high'
-            vpix_fmt = 'yuv420p10le'
-            audioBitrate = 512
-        elif resolution == 1440:
-            vwidth = 2560 if normal == True else 1920
-            vbitrate = 9000
-            vmaxrate = '19968k'
-            vbufsize = '29900k'
-            vprofile = 'high'
-            vpix_fmt = 'yuv420p10le'
-            audioBitrate = 384
-        elif resolution == 1080:
-            vwidth = 1920 if normal == True else 1440
-            vbitrate = 4900
-            vmaxrate = '9856k'
-            vbufsize = '14500k'
-            vprofile = 'high'
-            vpix_fmt = 'yuv420p'
-            audioBitrate = 256
-        elif resolution == 720:
-            vwidth = 1280 if normal == True else 960
-            vbitrate = 2850
-            vmaxrate = '6336k'
-            vbufsize = '9500k'
-            vprofile = 'high'
-            vpix_fmt = 'yuv420p'
-            audioBitrate = 192
-        elif resolution == 480:
-            vwidth = 854 if normal == True else 640
-            vbitrate = 1425
-            vmaxrate = '3432k'
-            vbufsize = '3500k'
-            vprofile = 'main'
-            vpix_fmt = 'yuv420p'
-            audioBitrate = 128
-        elif resolution == 360:
-            vwidth = 640 if normal == True else 480
-            vbitrate = 800
-            vmaxrate = '928k'
-            vbufsize = '1300k'
-            vprofile = 'baseline'
-            vpix_fmt = 'yuv420p'
-            audioBitrate = 96
-        elif resolution == 240:
-            vwidth = 426 if normal == True else 320
-            vbitrate = 500
-            vmaxrate = '652k'
-            vbufsize = '950k'
-            vprofile = 'baseline'
-            vpix_fmt = 'yuv420p'
-            audioBitrate = 64
+        rung = rung or self.ladder.rung(resolution)
+        if rung:
+            vwidth = rung.targetWidth(normal)
+            vbitrate = rung.bitrate
+            vmaxrate = rung.maxrate
+            vbufsize = rung.bufsize
+            vprofile = rung.profile
+            vpix_fmt = rung.pix_fmt
+            audioBitrate = rung.audiobitrate
+
+            # Sources that already satisfy the rung only need their video stream copied, except when packaging where its GOPs would not line up with the other rungs
+            if self.settings.copycompliant and self.settings.ladderoutput != 'hls' and self.isCompliant(inputFile, info, rung):
+                vcodec = 'copy'
+                vdebug = vdebug + ".copy-compliant"
         else:
             vwidth = None
             vbitrate = info.format.bitrate / 1000
@@ -552,9 +688,27 @@ class MediaProcessor:
             vprofile = 'high'
             vpix_fmt = 'yuv420p'
 
+        # Preset and tune of the output, a ladder plans them for all its rungs at once [encode-realtime]
+        profile = profile or self.profiler.plan(inputFile, info, {resolution: vwidth})[resolution]
+        vpreset = profile.preset
+
         vlevel = 0.0
         vfieldorder = info.video.field_order
 
+        # Only deinterlace sources that need it, telecined sources get their progressive frames restored instead
+        vfilter = self.scanAnalyzer.filter(inputFile, info) if vcodec != 'copy' else None
+        if vfilter:
+            vfieldorder = 'progressive'
+
+        # Crop black bars before scaling, narrowing the rung width by the share of columns cropped [auto-crop]
+        vcrop = None
+        if self.settings.autocrop and vcodec != 'copy':
+            crop = self.cropAnalyzer.crop(inputFile, info)
+            if crop:
+                vcrop = "%d:%d:%d:%d" % crop
+                if vwidth:
+                    vwidth = min(crop[0], int(round(vwidth * crop[0] / info.video.video_width / 2.0)) * 2)
+
         self.log.debug("Video codec: %s." % vcodec)
         self.log.debug("Video bitrate: %s." % vbitrate)
         self.log.debug("Video CRF: %s." % vcrf)
@@ -565,6 +719,8 @@ class MediaProcessor:
         self.log.debug("Video preset: %s." % vpreset)
         self.log.debug("Video pix format: %s." % vpix_fmt)
         self.log.debug("Video field order: %s." % vfieldorder)
+        self.log.debug("Video filter: %s." % vfilter)
+        self.log.debug("Video crop: %s." % vcrop)
         self.log.debug("Video width: %s." % vwidth)
         self.log.debug("Video debug %s." % vdebug)
         self.log.info("Creating %s video stream from source stream %d." % (vcodec, info.video.index))
@@ -578,12 +734,13 @@ class MediaProcessor:
             'bufsize': vbufsize,
             'level': vlevel,
             'profile': vprofile,
-            'tune': 'zerolatency',
+            'tune': profile.tune,
             'preset': vpreset,
             'pix_fmt': vpix_fmt,
             'field_order': vfieldorder,
             'width': vwidth,
-            'filter': 'bwdif=mode=send_field:parity=auto:deint=all',
+            'filter': vfilter,
+            'crop': vcrop,
             'title': self.videoStreamTitle(width=vwidth, swidth=info.video.video_width, sheight=info.video.video_height),
             'debug': vdebug,
         }
@@ -596,17 +753,20 @@ class MediaProcessor:
         blocked_audio_languages = []
 
         # Sort incoming streams so that things like first language preferences respect these options
-        audio_streams = info.audio
+        audio_streams = list(info.audio)
         try:
             self.sortStreams(audio_streams, awl)
         except:
             self.log.exception("Error sorting source audio streams [sort-streams].")
 
+        # Streams sharing a channel count and language, a TrueHD stream with a match usually has its AC3 core alongside
+        comparable = Counter((x.audio_channels, x.metadata['language']) for x in audio_streams)
+
         for a in audio_streams:
             self.log.info("Audio detected for stream %s - %s %s %d channel." % (a.index, a.codec, a.metadata['language'], a.audio_channels))
 
             if a.codec == 'truehd':
-                if len([x for x in info.audio if x.audio_channels == a.audio_channels and x.metadata['language'] == a.metadata['language']]) > 1:
+                if comparable[(a.audio_channels, a.metadata['language'])] > 1:
                     self.log.info("Skipping trueHD stream %s as typically the 2nd audio stream is the AC3 core of the truehd stream [audio-ignore-truehd]." % a.index)
                     continue
                 else:
@@ -642,28 +802,34 @@ class MediaProcessor:
                 adebug = "audio"
                 # If the universal audio option is enabled and the source audio channel is only stereo, the additional universal stream will be skipped and a single channel will be made regardless of codec preference to avoid multiple stereo channels
                 adisposition = a.dispostr
-                # If desired codec is the same as the source codec, copy to avoid quality loss
-                acodec = 'copy' if a.codec == 'aac' else 'aac'
                 if a.audio_channels <= 2 or audioBitrate <= 128:
                     self.log.debug("Overriding default channel settings because universal audio is enabled but the source is stereo [universal-audio].")
                     audio_channels = 2
                     abitrate = audioBitrate
                     adebug = "universal-audio"
-                    acodec = 'aac'
                 else:
                     # Audio channel adjustments
                     if a.audio_channels > 6:
                         self.log.debug("Audio source exceeds maximum channels, can not be copied. Settings channels to 6 [audio-max-channels].")
                         adebug = adebug + ".max-channels"
                         audio_channels = 6
-                        acodec = 'aac'
                         abitrate = 3 * audioBitrate
                     else:
                         audio_channels = a.audio_channels
                         abitrate = (a.audio_channels / 2) * audioBitrate
-                        acodec = 'aac'
+                asamplerate = 48000 if audioBitrate <= 256 else 96000
+
+                # Copy the source stream when it is already within what would be encoded, saving a decode and encode per rung
+                apassthrough = self.ladder.audioNonCompliance(a, audio_channels, abitrate, asamplerate)
+                if apassthrough:
+                    acodec = 'aac'
+                else:
+                    acodec = 'copy'
+                    adebug = adebug + ".copy"
+                    apassthrough = "%s %s %s channels %s Hz within %d channels %d Hz %dk" % (a.codec, a.profile, a.audio_channels, a.audio_samplerate, audio_channels, asamplerate, abitrate)
 
                 self.log.debug("Audio codec: %s." % acodec)
+                self.log.debug("Passthrough: %s." % apassthrough)
                 self.log.debug("Channels: %s." % audio_channels)
                 self.log.debug("Bitrate: %s." % abitrate)
                 self.log.debug("Language: %s." % a.metadata['language'])
@@ -681,10 +847,11 @@ class MediaProcessor:
                         'codec': acodec,
                         'channels': audio_channels,
                         'bitrate': abitrate,
-                        'samplerate': 48000 if audioBitrate <= 256 else 96000,
+                        'samplerate': asamplerate,
                         'language': a.metadata['language'],
                         'disposition': adisposition,
                         'title': self.audioStreamTitle(audio_channels, a.disposition),
+                        'passthrough': apassthrough,
                         'debug': adebug
                     })
 
@@ -825,7 +992,9 @@ class MediaProcessor:
         }
 
         preopts =  ['-hide_banner']
-        postopts = ['-threads', str(self.settings.threads), '-metadata:g', 'encoding_tool=MMT','-vsync', '1', '-g', '60', '-sc_threshold', '0', '-movflags', 'faststart']
+        postopts = ['-threads', str(profile.threads or self.settings.threads), '-metadata:g', 'encoding_tool=MMT', '-movflags', 'faststart']
+        if vcodec != 'copy':
+            postopts.extend(['-vsync', '1', '-g', '60', '-sc_threshold', '0'])
 
         # FFMPEG allows TrueHD experimental
         if options.get('format') in ['mp4']:
@@ -870,17 +1039,63 @@ class MediaProcessor:
 
         return options, preopts, postopts, ripSubOpts, downloadedSubs
 
+    # Report for a job which audio streams are copied from the source and why the others have to be encoded
+    def audioPassthroughReport(self, rungs):
+        copied = 0
+        total = 0
+        for resolution, options, _ in rungs:
+            output = "%sp" % resolution if resolution else "Output"
+            for a in options['audio']:
+                if 'passthrough' not in a:
+                    continue
+                total += 1
+                if a['codec'] == 'copy':
+                    copied += 1
+                    self.log.info("%s copies audio stream %d, %s [audio-passthrough]." % (output, a['map'], a['passthrough']))
+                else:
+                    self.log.info("%s encodes audio stream %d, %s [audio-passthrough]." % (output, a['map'], a['passthrough']))
+        self.log.info("Audio passthrough report: %d of %d audio streams copied." % (copied, total))
+
+    # Check whether the source video stream can be copied into a rung as is, measuring its peak bitrate over the rung's buffer duration last as it reads every packet
+    def isCompliant(self, inputFile, info, rung):
+        reason = self.ladder.nonCompliance(info, rung)
+        if not reason:
+            maxrate = int(rung.maxrate[:-1])
+            bufsize = int(rung.bufsize[:-1])
+            peak = self.peakBitrate(inputFile, (1.0 * bufsize) / maxrate)
+            if not peak:
+                reason = "peak bitrate could not be measured"
+            elif peak / 1000 > maxrate:
+                reason = "peak bitrate %d kbps exceeds %d kbps" % (peak / 1000, maxrate)
+            else:
+                self.log.debug("Peak bitrate %d kbps within %d kbps." % (peak / 1000, maxrate))
+
+        if reason:
+            self.log.info("Source video does not comply with %sp, %s [copy-compliant-video]." % (rung.resolution, reason))
+            return False
+        self.log.info("Source video complies with %sp, copying video stream [copy-compliant-video]." % rung.resolution)
+        return True
+
+    # Peak video bitrate over a window in seconds, reading the whole file so cached with its probe for every window measured
+    def peakBitrate(self, inputFile, window):
+        name = 'peak-bitrate-%.3f' % window
+        peak = self.converter.get_result(inputFile, name)
+        if peak is None:
+            peak = self.converter.peak_bitrate(inputFile, window=window, stream='v:0')
+            if peak:
+                self.converter.put_result(inputFile, name, peak)
+        return peak
+
     def validLanguage(self, language, whitelist, blocked=[]):
         return ((len(whitelist) < 1 or language in whitelist) and language not in blocked)
 
     def setAcceleration(self, video_codec):
         opts = []
         device = None
-        # Look up which codecs and which decoders/encoders are available in this build of ffmpeg
-        codecs = self.converter.ffmpeg.codecs
-
-        # Lookup which hardware acceleration platforms are available in this build of ffmpeg
-        hwaccels = self.converter.ffmpeg.hwaccels
+        # Look up which codecs, decoders/encoders and hardware acceleration platforms are available in this build of ffmpeg, discovered once per binary
+        capabilities = self.converter.ffmpeg.capabilities
+        codecs = capabilities.codecs
+        hwaccels = capabilities.hwaccels
 
         self.log.debug("Selected hwaccel options:")
         self.log.debug(self.settings.hwaccels)
@@ -908,7 +1123,7 @@ class MediaProcessor:
                 # If there's a decoder for this acceleration platform, also use it
                 decoder = self.converter.ffmpeg.hwaccel_decoder(video_codec, hwaccel)
                 self.log.debug("Decoder: %s." % decoder)
-                if (decoder in codecs[video_codec]['decoders'] and decoder in self.settings.hwaccel_decoders):
+                if (capabilities.decoder_codec.get(decoder) == video_codec and decoder in self.settings.hwaccel_decoders):
                     self.log.info("%s decoder is also supported by this ffmpeg build and will also be used [hwaccel-decoders]." % decoder)
                     opts.extend(['-vcodec', decoder])
                 break
@@ -1225,13 +1440,17 @@ class MediaProcessor:
         return False
 
     # Encode a new file based on selected options, built in naming conflict resolution
-    def convert(self, options, preopts, postopts, reportProgress=False, progressOutput=None, resolution=None):
+    def convert(self, options, preopts, postopts, reportProgress=False, progressOutput=None, resolution=None, outputFile=None, finalOutputFile=None, info=None):
         self.log.info("Starting conversion.")
         inputFile = options['source'][0]
         inputDir, filename, inputExtension = self.parseFile(inputFile)
         originalInputFile = inputFile
-        outputFile, outputDir = self.getOutputFile(inputDir, filename, inputExtension, 'part', resolution=resolution)
-        finalOutputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, resolution=resolution)
+
+        # Output paths may already have been reserved by the caller when several rungs are converted at once
+        reserved = outputFile and finalOutputFile
+        if not reserved:
+            outputFile, outputDir = self.getOutputFile(inputDir, filename, inputExtension, 'part', resolution=resolution)
+            finalOutputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, resolution=resolution)
 
         self.log.debug("Final output file: %s." % finalOutputFile)
 
@@ -1240,7 +1459,7 @@ class MediaProcessor:
             return None, inputFile
 
         # Check if input file and the final output file are the same and preferentially rename files (input first, then output if that fails)
-        if os.path.abspath(inputFile) == os.path.abspath(finalOutputFile):
+        if not reserved and os.path.abspath(inputFile) == os.path.abspath(finalOutputFile):
             self.log.debug("Inputfile and final outputFile are the same, trying to rename inputFile first.")
             try:
                 og = inputFile + ".original"
@@ -1261,19 +1480,27 @@ class MediaProcessor:
                     i += 1
                 self.log.debug("Unable to rename inputFile. Alternatively renaming output file to %s." % outputFile)
 
-        # Delete output file if it already exists and deleting enabled
-        if os.path.exists(outputFile) and self.settings.delete:
-            self.removeFile(outputFile)
+        if not reserved:
+            # Delete output file if it already exists and deleting enabled
+            if os.path.exists(outputFile) and self.settings.delete:
+                self.removeFile(outputFile)
 
-        # Final sweep to make sure outputFile does not exist, renaming as the final solution
-        i = 2
-        while os.path.isfile(outputFile):
-            outputFile, outputDir = self.getOutputFile(inputDir, filename, inputExtension, 'part', number=i, resolution=resolution)
-            finalOutputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, number=i, resolution=resolution)
-            i += 1
+            # Final sweep to make sure outputFile does not exist, renaming as the final solution
+            i = 2
+            while os.path.isfile(outputFile):
+                outputFile, outputDir = self.getOutputFile(inputDir, filename, inputExtension, 'part', number=i, resolution=resolution)
+                finalOutputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, number=i, resolution=resolution)
+                i += 1
+
+        # Full ffmpeg output is spilled next to the output and only kept when the encode fails
+        logFile = outputFile + '.log'
 
         try:
-            conv = self.converter.convert(outputFile, options, timeout=None, preopts=preopts, postopts=postopts, strip_metadata=True)
+            chunks = self.planChunks(options, postopts, info) if self.settings.chunkedencoding else None
+            if chunks:
+                conv = self.convertChunked(outputFile, options, preopts, postopts, info, chunks)
+            else:
+                conv = self.converter.convert(outputFile, options, timeout=None, preopts=preopts, postopts=postopts, strip_metadata=True, info=info, logfile=logFile)
         except:
             self.log.exception("Error converting file.")
             return None, inputFile
@@ -1285,28 +1512,19 @@ class MediaProcessor:
         self.log.info("======================")
 
         try:
-            timecode = 0
-            debug = ""
-            for timecode, debug in conv:
-                self.log.debug(debug)
-                if reportProgress:
-                    if progressOutput:
-                        progressOutput(timecode, debug)
-                    else:
-                        self.displayProgressBar(timecode, debug)
-            if reportProgress:
-                if progressOutput:
-                    progressOutput(100, debug)
-                else:
-                    self.displayProgressBar(100, newline=True)
+            self.driveConversion(conv, reportProgress, progressOutput)
 
             self.log.info("%s created." % outputFile)
             self.setPermissions(outputFile)
+            if os.path.isfile(logFile):
+                self.removeFile(logFile)
 
         except FFMpegConvertError as e:
             self.log.exception("Error converting file, FFMPEG error.")
             self.log.error(e.cmd)
             self.log.error(e.output)
+            if os.path.isfile(logFile):
+                self.log.error("Full FFmpeg output kept in %s." % logFile)
             if os.path.isfile(outputFile):
                 self.removeFile(outputFile)
                 self.log.error("%s deleted." % outputFile)
@@ -1337,6 +1555,458 @@ class MediaProcessor:
 
         return finalOutputFile, inputFile
 
+    # Split a video encode into GOP aligned chunks sized from the cores available to it, None when chunking would not pay off
+    def planChunks(self, options, postopts, info):
+        info = info or self.converter.probe(options['source'][0])
+        if not info or not info.video or not info.format.duration or options['video'].get('codec') == 'copy':
+            return None
+
+        threads = int(postopts[postopts.index('-threads') + 1]) if '-threads' in postopts else 0
+        cores = threads or self.settings.threads or os.cpu_count() or 1
+        workers = cores // self.chunkThreads
+        if workers < 2:
+            self.log.debug("Not enough cores for chunked encoding, encoding in one piece [chunked-encoding].")
+            return None
+
+        # Chunks are a whole number of GOPs counted in frames so the joined stream keeps the fixed GOP layout and every source frame exactly once,
+        # a few chunks per process keep every process busy until the end
+        gop = int(postopts[postopts.index('-g') + 1]) if '-g' in postopts else 60
+        fps = info.video.fps or 24.0
+        length = max(self.chunkMinLength, info.format.duration / (workers * 3))
+        frames = int(math.ceil(length * fps / gop)) * gop
+        count = int(math.ceil(info.format.duration * fps / frames))
+        if count < 2:
+            self.log.debug("Source too short for chunked encoding, encoding in one piece [chunked-encoding].")
+            return None
+        return workers, cores // workers, frames, count
+
+    # Encode the video in chunks on concurrent ffmpeg processes, then join them losslessly with the concat demuxer while muxing every other stream from the source
+    def convertChunked(self, outputFile, options, preopts, postopts, info, chunks):
+        workers, threads, frames, count = chunks
+        duration = info.format.duration
+        fps = info.video.fps or 24.0
+        length = frames / fps
+
+        chunkOptions = dict(options, source=options['source'][:1], format='mp4', audio=[], subtitle=[], attachment=[])
+        chunkPostopts = list(postopts)
+        if '-threads' in chunkPostopts:
+            chunkPostopts[chunkPostopts.index('-threads') + 1] = str(threads)
+        else:
+            chunkPostopts.extend(['-threads', str(threads)])
+        chunkFiles = ["%s.chunk%03d" % (outputFile, i) for i in range(count)]
+        listFile = "%s.chunks" % outputFile
+
+        # Seeking half a frame ahead of the first frame of a chunk lands on that frame however the timestamp is rounded, a frame count rather than a duration ends
+        # the chunk so no frame is dropped or encoded twice at a boundary. The last chunk runs to the end of the source
+        convs = []
+        for i in range(count):
+            seek = ['-ss', '%.6f' % max(0, (i * frames - 0.5) / fps)] if i else []
+            limit = ['-frames:v', str(frames)] if i + 1 < count else []
+            convs.append(self.converter.convert(chunkFiles[i], chunkOptions, timeout=None, preopts=preopts + seek, postopts=chunkPostopts + limit, strip_metadata=True, info=info))
+        commands = [next(conv)[1] for conv in convs]
+        yield 0, commands[0]
+
+        self.log.info("Encoding %d chunks of %.1f seconds on %d processes with %d threads each [chunked-encoding]." % (count, length, workers, threads))
+
+        # Each chunk reports its progress as a share of the whole source
+        progress = [0] * count
+        # Set when a chunk fails so the other running chunks stop, closing a conversion kills its ffmpeg process
+        stop = Event()
+
+        def encode(i):
+            encoded = None
+            for timecode, event in convs[i]:
+                if stop.is_set():
+                    convs[i].close()
+                    return
+                progress[i] = timecode
+                if isinstance(event, ProgressEvent) and event.frame is not None:
+                    encoded = event.frame
+            # A short chunk would shift every later chunk against the audio muxed from the source
+            if i + 1 < count and encoded is not None and encoded != frames:
+                raise ConverterError("Chunk %d encoded %d frames instead of %d." % (i, encoded, frames))
+            progress[i] = 100.0 * min(length, duration - i * length) / duration
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set(executor.submit(encode, i) for i in range(count))
+                try:
+                    while pending:
+                        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                        yield min(99, int(sum(progress))), "%d of %d chunks encoded" % (count - len(pending), count)
+                except:
+                    stop.set()
+                    for future in pending:
+                        future.cancel()
+                    raise
+
+            with open(listFile, 'w') as f:
+                for chunkFile in chunkFiles:
+                    f.write("file '%s'\n" % chunkFile.replace("'", "'\\''"))
+
+            # Sources shift by one with the chunk list taking the first input
+            remuxOptions = dict(options, source=[listFile] + options['source'])
+            remuxOptions['video'] = {'codec': 'copy', 'map': 0, 'title': options['video'].get('title')}
+            for key in ['audio', 'subtitle', 'attachment']:
+                remuxOptions[key] = [dict(x, source=int(x.get('source', 0)) + 1) for x in options.get(key, [])]
+
+            conv = self.converter.convert(outputFile, remuxOptions, timeout=None, preopts=['-hide_banner', '-f', 'concat', '-safe', '0'], postopts=postopts, strip_metadata=True, info=info, logfile=outputFile + '.log')
+            _, cmds = next(conv)
+            self.log.info("Joining chunks:")
+            self.log.info(" ".join("\"%s\"" % item if " " in item and "\"" not in item else item for item in cmds))
+            for _, debug in conv:
+                yield 99, debug
+        finally:
+            for chunkFile in chunkFiles + [listFile]:
+                if os.path.exists(chunkFile):
+                    self.removeFile(chunkFile)
+
+    # Encode several ladder rungs with a single ffmpeg process, built in naming conflict resolution
+    def convertLadder(self, rungs, preopts, reportProgress=False, progressOutput=None, info=None, manifest=None):
+        self.log.info("Starting ladder conversion.")
+        inputFile = rungs[0][1]['source'][0]
+
+        outputs = []
+        for resolution, options, postopts in rungs:
+            if len(options['audio']) == 0:
+                self.log.error("Conversion has no audio streams, aborting")
+                return {}
+
+            outputFile, finalOutputFile = self.reserveOutputFiles(inputFile, resolution, options)
+            if manifest:
+                manifest.start(resolution, outputFile)
+            outputs.append((resolution, outputFile, finalOutputFile, options, postopts))
+
+        logFile = outputs[0][1] + '.log'
+        try:
+            conv = self.converter.convert_ladder([(x[1], x[3], x[4]) for x in outputs], timeout=None, preopts=preopts, strip_metadata=True, info=info, logfile=logFile)
+            _, cmds = next(conv)
+        except:
+            self.log.exception("Error converting file.")
+            return {}
+
+        self.log.info("FFmpeg command:")
+        self.log.info("======================")
+        self.log.info(" ".join("\"%s\"" % item if " " in item and "\"" not in item else item for item in cmds))
+        self.log.info("======================")
+        self.log.info("Encoding %s from a single decode of %s." % (", ".join("%sp" % x[0] for x in outputs), inputFile))
+
+        try:
+            self.driveConversion(conv, reportProgress, progressOutput)
+        except FFMpegConvertError as e:
+            self.log.exception("Error converting file, FFMPEG error.")
+            self.log.error(e.cmd)
+            self.log.error(e.output)
+            if os.path.isfile(logFile):
+                self.log.error("Full FFmpeg output kept in %s." % logFile)
+            for output in outputs:
+                if os.path.isfile(output[1]):
+                    self.removeFile(output[1])
+                    self.log.error("%s deleted." % output[1])
+            return {}
+        except:
+            self.log.exception("Unexpected exception during conversion.")
+            return {}
+
+        if os.path.isfile(logFile):
+            self.removeFile(logFile)
+
+        finalOutputFiles = {}
+        for resolution, outputFile, finalOutputFile, _, _ in outputs:
+            self.log.info("%s created." % outputFile)
+            self.setPermissions(outputFile)
+            try:
+                os.rename(outputFile, finalOutputFile)
+            except:
+                self.log.exception("Unable to rename output file to its final destination file extension [tempExtension].")
+                finalOutputFile = outputFile
+            finalOutputFiles[resolution] = finalOutputFile
+            if manifest:
+                manifest.complete(resolution, finalOutputFile)
+        return finalOutputFiles
+
+    # Encode ladder rungs one after another
+    def convertSequential(self, rungs, preopts, reportProgress=False, progressOutput=None, info=None, manifest=None):
+        self.log.info("Starting sequential ladder conversion.")
+        inputFile = rungs[0][1]['source'][0]
+
+        finalOutputFiles = {}
+        for resolution, options, postopts in rungs:
+            outputFile, finalOutputFile = self.reserveOutputFiles(inputFile, resolution, options)
+            if manifest:
+                manifest.start(resolution, outputFile)
+            outputFile, _ = self.convert(options, preopts, postopts, reportProgress, progressOutput, resolution=resolution, outputFile=outputFile, finalOutputFile=finalOutputFile, info=info)
+            if outputFile:
+                finalOutputFiles[resolution] = outputFile
+                if manifest:
+                    manifest.complete(resolution, outputFile)
+            else:
+                self.log.error("%sp encode failed." % resolution)
+        return finalOutputFiles
+
+    # Transcode the audio and subtitle streams once per distinct set of stream options, then point every rung at the result so they only stream copy them
+    def shareStreams(self, rungs, preopts, info):
+        groups = {}
+        for resolution, options, postopts in rungs:
+            # Streams that are only copied cost nothing to repeat for every rung
+            if all(x.get('codec') == 'copy' for x in options['audio'] + options['subtitle']):
+                continue
+            key = json.dumps({'source': options['source'], 'audio': options['audio'], 'subtitle': options['subtitle']}, sort_keys=True)
+            groups.setdefault(key, []).append(options)
+
+        # Streams only one rung encodes are cheaper to encode in that rung than in an extra pass
+        groups = OrderedDict((k, v) for k, v in groups.items() if len(v) > 1)
+        if not groups:
+            return []
+
+        inputFile = rungs[0][1]['source'][0]
+        inputDir, filename, inputExtension = self.parseFile(inputFile)
+        sharedPreopts = [x for x in preopts if x in ['-hide_banner', '-fix_sub_duration']]
+        sharedPostopts = ['-threads', str(self.settings.threads)]
+        if any('-strict' in postopts for _, _, postopts in rungs):
+            sharedPostopts.extend(['-strict', 'experimental'])
+
+        outputs = []
+        for i, key in enumerate(groups):
+            options = groups[key][0]
+            sharedFile, _ = self.getOutputFile(inputDir, filename, inputExtension, 'streams%d.part' % i)
+            if os.path.exists(sharedFile):
+                self.removeFile(sharedFile)
+            outputs.append((sharedFile, {'source': options['source'], 'format': 'mp4', 'audio': options['audio'], 'subtitle': options['subtitle']}, sharedPostopts))
+
+        try:
+            conv = self.converter.convert_ladder(outputs, timeout=None, preopts=sharedPreopts, strip_metadata=True, info=info)
+            _, cmds = next(conv)
+            self.log.info("Shared stream FFmpeg command:")
+            self.log.info("======================")
+            self.log.info(" ".join("\"%s\"" % item if " " in item and "\"" not in item else item for item in cmds))
+            self.log.info("======================")
+            self.driveConversion(conv)
+        except FFMpegConvertError as e:
+            self.log.exception("Error encoding shared streams, FFMPEG error. Each rung will encode its own streams.")
+            self.log.error(e.cmd)
+            self.log.error(e.output)
+            for sharedFile, _, _ in outputs:
+                self.removeFile(sharedFile)
+            return []
+        except:
+            self.log.exception("Unexpected exception encoding shared streams. Each rung will encode its own streams.")
+            for sharedFile, _, _ in outputs:
+                self.removeFile(sharedFile)
+            return []
+
+        # ffmpeg starts every input at zero, an intermediate whose streams started late in the source is shifted back by its start time to stay in sync
+        offsets = []
+        for sharedFile, _, _ in outputs:
+            sharedInfo = self.converter.probe(sharedFile)
+            if not sharedInfo:
+                self.log.error("Unable to probe shared stream file %s. Each rung will encode its own streams." % sharedFile)
+                for x in outputs:
+                    self.removeFile(x[0])
+                return []
+            offsets.append(sharedInfo.format.start_time or 0)
+
+        for i, key in enumerate(groups):
+            # Single decode ladders need every rung to have the same input list
+            if self.settings.laddermode == 'single-decode':
+                sources = [inputFile] + [x[0] for x in outputs]
+                sourceOffsets = dict((j + 1, x) for j, x in enumerate(offsets))
+                source = i + 1
+            else:
+                sources = [inputFile, outputs[i][0]]
+                sourceOffsets = {1: offsets[i]}
+                source = 1
+            for options in groups[key]:
+                audio = options['audio']
+                options['audio'] = [dict(a, map=j, source=source, codec='copy') for j, a in enumerate(audio)]
+                options['subtitle'] = [dict(x, map=len(audio) + j, source=source, codec='copy') for j, x in enumerate(options['subtitle'])]
+                options['source'] = list(sources)
+                options['source-offsets'] = sourceOffsets
+
+        # Rungs that don't use the shared streams still read the same inputs as the others in a single decode
+        if self.settings.laddermode == 'single-decode':
+            for _, options, _ in rungs:
+                options['source'] = [inputFile] + [x[0] for x in outputs]
+                options['source-offsets'] = dict((j + 1, x) for j, x in enumerate(offsets))
+        self.log.info("Encoded %d shared stream set(s) for %d rungs." % (len(groups), len(rungs)))
+        return [x[0] for x in outputs]
+
+    # Write a rung as CMAF segments and an HLS media playlist in the package directory instead of a standalone mp4
+    def packageOptions(self, options, postopts, resolution, packageDir, info):
+        name = "%sp" % resolution
+        options['format'] = 'hls'
+        options['playlist'] = os.path.join(packageDir, name + '.m3u8')
+        options['init-filename'] = name + '_init.mp4'
+        options['segment-filename'] = os.path.join(packageDir, name + '_%05d.m4s')
+
+        # Segments are two GOPs long so every rung is cut at the same keyframes
+        if '-g' in postopts:
+            options['segment-duration'] = 2.0 * int(postopts[postopts.index('-g') + 1]) / (info.video.fps or 24.0)
+
+        # Text subtitles and attachments have no place in a CMAF variant
+        options['subtitle'] = []
+        options['attachment'] = []
+
+        # The hls muxer writes its own fragmented mp4 and rejects faststart
+        if '-movflags' in postopts:
+            i = postopts.index('-movflags')
+            del postopts[i:i + 2]
+
+    # Encode the ladder straight into a CMAF package, an HLS master playlist over every rung plus an optional DASH MPD
+    def processPackage(self, inputFile, plan, reportProgress=False, original=None, info=None, progressOutput=None):
+        info = info or self.isValidSource(inputFile)
+        if not info:
+            return None
+
+        inputDir, filename, inputExtension = self.parseFile(inputFile)
+        packageDir, _ = self.getOutputFile(inputDir, filename, inputExtension)
+        packageDir = os.path.splitext(packageDir)[0]
+
+        # An existing package directory is kept so an interrupted job can resume into it
+        try:
+            os.makedirs(packageDir, exist_ok=True)
+        except:
+            self.log.exception("Unable to create package directory %s." % packageDir)
+            return None
+
+        outputs = self.processLadder(inputFile, plan, reportProgress, original, info, progressOutput, packageDir=packageDir)
+        if len(outputs) < len(plan):
+            self.log.error("Only %d of %d rungs were packaged, not writing the master playlist." % (len(outputs), len(plan)))
+            return None
+
+        variants = []
+        for rung in plan:
+            playlist = outputs[rung.resolution]['output']
+            variants.append((playlist, self.converter.probe(playlist) or info))
+
+        packager = Packager(packageDir, self.log)
+        try:
+            packager.writeMaster(variants)
+            if self.settings.dashmanifest:
+                packager.writeMpd(variants, info.format.duration)
+        except:
+            self.log.exception("Unable to write package manifests for %s." % packageDir)
+            return None
+
+        for root, _, files in os.walk(packageDir):
+            for f in files:
+                self.setPermissions(os.path.join(root, f))
+        return packageDir
+
+    # Job manifest for a source, kept next to its output
+    def getManifestFile(self, inputFile):
+        inputDir, filename, inputExtension = self.parseFile(inputFile)
+        manifestFile, _ = self.getOutputFile(inputDir, filename, inputExtension, 'mmt-job.json')
+        return manifestFile
+
+    # Pick the temporary and final output files for a ladder rung without ever touching the source, which every rung reads from
+    def reserveOutputFiles(self, inputFile, resolution, options=None):
+        # Packaged rungs are written to their media playlist inside the package directory
+        if options and options.get('playlist'):
+            outputFile = options['playlist'] + '.part'
+            if os.path.exists(outputFile):
+                self.removeFile(outputFile)
+            self.log.debug("Media playlist for %sp: %s." % (resolution, options['playlist']))
+            return outputFile, options['playlist']
+
+        inputDir, filename, inputExtension = self.parseFile(inputFile)
+        outputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, 'part', resolution=resolution)
+        finalOutputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, resolution=resolution)
+
+        # Delete output file if it already exists and deleting enabled
+        if os.path.exists(outputFile) and self.settings.delete:
+            self.removeFile(outputFile)
+
+        i = 2
+        while os.path.abspath(finalOutputFile) == os.path.abspath(inputFile) or os.path.isfile(outputFile):
+            outputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, 'part', number=i, resolution=resolution)
+            finalOutputFile, _ = self.getOutputFile(inputDir, filename, inputExtension, number=i, resolution=resolution)
+            i += 1
+
+        self.log.debug("Final output file for %sp: %s." % (resolution, finalOutputFile))
+        return outputFile, finalOutputFile
+
+    # Encode ladder rungs as concurrent ffmpeg processes, splitting the core budget between running rungs by their planned threads or else by pixel count
+    def convertParallel(self, rungs, preopts, info, manifest=None, profiles=None):
+        self.log.info("Starting parallel ladder conversion.")
+        inputFile = rungs[0][1]['source'][0]
+
+        cores = self.settings.threads or os.cpu_count() or 1
+        maxProcesses = self.settings.maxprocesses or min(len(rungs), cores)
+        aspect = (1.0 * info.video.video_height) / info.video.video_width
+
+        # Rungs are weighted by their planned threads when every rung has them, by pixel count otherwise as the two can't be mixed.
+        # Largest rungs first so the longest encodes start immediately
+        profiles = profiles or {}
+        planned = all(profiles.get(x[0]) and profiles[x[0]].threads for x in rungs)
+        pending = []
+        for resolution, options, postopts in rungs:
+            width = options['video'].get('width') or info.video.video_width
+            weight = profiles[resolution].threads if planned else width * width * aspect
+            pending.append((weight, resolution, options, postopts))
+        pending.sort(key=lambda x: x[0], reverse=True)
+
+        finalOutputFiles = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=maxProcesses) as executor:
+            while pending or running:
+                # Rungs started together share the cores not already held by running rungs, weighted by planned threads or pixel count
+                starting = pending[:maxProcesses - len(running)]
+                pending = pending[len(starting):]
+                budget = max(cores - sum(x[1] for x in running.values()), len(starting))
+                pixels = sum(x[0] for x in starting)
+                for px, resolution, options, postopts in starting:
+                    threads = max(1, int(round(budget * px / pixels)))
+                    postopts = list(postopts)
+                    if '-threads' in postopts:
+                        postopts[postopts.index('-threads') + 1] = str(threads)
+                    else:
+                        postopts.extend(['-threads', str(threads)])
+                    outputFile, finalOutputFile = self.reserveOutputFiles(inputFile, resolution, options)
+                    if manifest:
+                        manifest.start(resolution, outputFile)
+                    self.log.info("Starting %sp encode with %d threads." % (resolution, threads))
+                    future = executor.submit(self.convert, options, preopts, postopts, resolution=resolution, outputFile=outputFile, finalOutputFile=finalOutputFile, info=info)
+                    running[future] = (resolution, threads)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    resolution, threads = running.pop(future)
+                    try:
+                        outputFile, _ = future.result()
+                    except:
+                        self.log.exception("Unexpected exception encountered during %sp conversion." % resolution)
+                        outputFile = None
+                    if outputFile:
+                        self.log.info("%sp encode finished, releasing %d threads." % (resolution, threads))
+                        finalOutputFiles[resolution] = outputFile
+                        if manifest:
+                            manifest.complete(resolution, outputFile)
+                    else:
+                        self.log.error("%sp encode failed." % resolution)
+        return finalOutputFiles
+
+    # Iterate a conversion generator to completion, reporting progress along the way
+    def driveConversion(self, conv, reportProgress=False, progressOutput=None):
+        timecode = 0
+        debug = ""
+        for timecode, debug in conv:
+            self.log.debug(debug)
+            if reportProgress:
+                if progressOutput:
+                    progressOutput(timecode, debug)
+                else:
+                    self.displayProgressBar(timecode, debug)
+        if isinstance(debug, ProgressEvent):
+            self.log.info("Encoded %s frames at %s fps, %sx realtime, %s kbps." % (debug.frame, debug.fps, debug.speed, debug.bitrate))
+        if reportProgress:
+            if progressOutput:
+                progressOutput(100, debug)
+            else:
+                self.displayProgressBar(100, newline=True)
+
     def displayProgressBar(self, complete, debug="", width=20, newline=False):
         try:
             divider = 100 / width
@@ -1346,11 +2016,15 @@ class MediaProcessor:
 
             sys.stdout.write('\r')
             sys.stdout.write('[{0}] {1}% '.format('#' * int(round(complete / divider)) + ' ' * int(round(width - (complete / divider))), complete))
+            if isinstance(debug, ProgressEvent):
+                eta = debug.eta(complete)
+                if eta is not None:
+                    sys.stdout.write('%.2fx ETA %s ' % (debug.speed, time.strftime('%H:%M:%S', time.gmtime(eta))))
             if debug and self.settings.detailedprogress:
                 if complete == 100:
-                    sys.stdout.write("%s" % debug.strip())
+                    sys.stdout.write("%s" % str(debug).strip())
                 else:
-                    sys.stdout.write(" %s" % debug.strip())
+                    sys.stdout.write(" %s" % str(debug).strip())
             if newline:
                 sys.stdout.write('\n')
             sys.stdout.flush()
@@ -1387,6 +2061,7 @@ class MediaProcessor:
             try:
                 processor.process(inputFile, outputFile)
                 self.setPermissions(outputFile)
+                self.converter.invalidate(inputFile)
 
                 # Cleanup
                 if self.removeFile(inputFile, replacement=outputFile):
@@ -244,6 +244,7 @@ class Metadata:
         try:
             self.log.info("Trying to write tags.")
             video.save()
+            converter.invalidate(path)
             self.log.info("Tags written successfully using mutagen.")
             return True
         except:
@@ -0,0 +1,123 @@
+import os
+import logging
+
+
+# Writes the HLS master playlist and DASH MPD for a ladder packaged as CMAF segments with one HLS media playlist per rung
+class Packager:
+    profileIdc = {
+        'constrained baseline': (0x42, 0xC0),
+        'baseline': (0x42, 0x00),
+        'main': (0x4D, 0x00),
+        'high': (0x64, 0x00),
+        'high 10': (0x6E, 0x00),
+    }
+    audioCodecs = {
+        'aac': 'mp4a.40.2',
+        'ac3': 'ac-3',
+        'eac3': 'ec-3',
+    }
+
+    def __init__(self, packageDir, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.packageDir = packageDir
+
+    # RFC 6381 codecs string for a probed output
+    def codecs(self, info):
+        codecs = []
+        if info.video and info.video.codec == 'h264' and info.video.profile in self.profileIdc:
+            profile, constraints = self.profileIdc[info.video.profile]
+            codecs.append("avc1.%02X%02X%02X" % (profile, constraints, int(round((info.video.video_level or 0) * 10))))
+        for a in info.audio:
+            if a.codec in self.audioCodecs and self.audioCodecs[a.codec] not in codecs:
+                codecs.append(self.audioCodecs[a.codec])
+        return ",".join(codecs)
+
+    # Segment durations and files listed by a media playlist along with its init segment
+    def readPlaylist(self, playlist):
+        init = None
+        segments = []
+        duration = None
+        with open(playlist, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#EXT-X-MAP:'):
+                    init = line.split('URI="', 1)[1].split('"', 1)[0]
+                elif line.startswith('#EXTINF:'):
+                    duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+                elif line and not line.startswith('#') and duration is not None:
+                    segments.append((duration, line))
+                    duration = None
+        return init, segments
+
+    # Peak and average bitrate of a media playlist measured from its segments, in bits per second
+    def bandwidth(self, segments):
+        peak = 0
+        size = 0
+        duration = 0
+        for length, segment in segments:
+            segmentSize = os.path.getsize(os.path.join(self.packageDir, segment))
+            if length > 0:
+                peak = max(peak, segmentSize * 8 / length)
+            size += segmentSize
+            duration += length
+        return int(peak), int(size * 8 / duration) if duration else 0
+
+    def writeMaster(self, variants):
+        master = os.path.join(self.packageDir, 'master.m3u8')
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-INDEPENDENT-SEGMENTS']
+        for playlist, info in variants:
+            _, segments = self.readPlaylist(playlist)
+            peak, average = self.bandwidth(segments)
+            attributes = ['BANDWIDTH=%d' % peak, 'AVERAGE-BANDWIDTH=%d' % average]
+            if info.video:
+                attributes.append('RESOLUTION=%dx%d' % (info.video.video_width, info.video.video_height))
+                if info.video.fps:
+                    attributes.append('FRAME-RATE=%.3f' % info.video.fps)
+            codecs = self.codecs(info)
+            if codecs:
+                attributes.append('CODECS="%s"' % codecs)
+            lines.append('#EXT-X-STREAM-INF:' + ','.join(attributes))
+            lines.append(os.path.basename(playlist))
+
+        with open(master, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.log.info("HLS master playlist written to %s." % master)
+        return master
+
+    # Static MPD addressing the same CMAF segments through a SegmentTimeline
+    def writeMpd(self, variants, duration):
+        mpd = os.path.join(self.packageDir, 'manifest.mpd')
+        representations = []
+        for playlist, info in variants:
+            init, segments = self.readPlaylist(playlist)
+            if not init or not segments:
+                self.log.error("Unable to read segments from %s, leaving it out of the MPD." % playlist)
+                continue
+            peak, _ = self.bandwidth(segments)
+            name = os.path.splitext(os.path.basename(playlist))[0]
+            first = segments[0][1]
+            media = name + '_$Number%05d$' + os.path.splitext(first)[1]
+            startNumber = int(os.path.splitext(first)[0][len(name) + 1:])
+            timeline = ''.join('<S d="%d"/>' % int(round(length * 1000)) for length, _ in segments)
+            representations.append(
+                '      <Representation id="%s" bandwidth="%d" width="%d" height="%d" codecs="%s">\n'
+                '        <SegmentTemplate timescale="1000" initialization="%s" media="%s" startNumber="%d">\n'
+                '          <SegmentTimeline>%s</SegmentTimeline>\n'
+                '        </SegmentTemplate>\n'
+                '      </Representation>' % (name, peak, info.video.video_width, info.video.video_height, self.codecs(info), init, media, startNumber, timeline))
+
+        lines = [
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" profiles="urn:mpeg:dash:profile:isoff-live:2011" type="static" mediaPresentationDuration="PT%.3fS" minBufferTime="PT4S">' % duration,
+            '  <Period id="0" start="PT0S">',
+            '    <AdaptationSet id="0" mimeType="video/mp4" segmentAlignment="true" startWithSAP="1">',
+        ] + representations + [
+            '    </AdaptationSet>',
+            '  </Period>',
+            '</MPD>',
+        ]
+
+        with open(mpd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.log.info("DASH manifest written to %s." % mpd)
+        return mpd
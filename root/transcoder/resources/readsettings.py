@@ -108,6 +108,25 @@ class ReadSettings:
             'detailed-progress': False,
             'attachment-codec': '',
             'multi-bitrate': False,
+            'ladder-mode': 'sequential',
+            'max-processes': 0,
+            'ladder-min-savings': 0.25,
+            'chunked-encoding': False,
+            'copy-compliant-video': False,
+            'ladder-output': 'mp4',
+            'dash-manifest': False,
+            'per-title-bitrate': False,
+            'analysis-samples': 6,
+            'probe-cache': '',
+            'probe-workers': 4,
+            'trickplay': '',
+            'trickplay-interval': 10,
+            'trickplay-width': 320,
+            'auto-crop': False,
+            'encode-realtime': 0,
+            'encode-daily-hours': 0,
+            'encode-presets': 'veryfast, faster, fast, medium, slow',
+            'encode-tune': 'zerolatency',
         },
         'Permissions': {
             'chmod': '0644',
@@ -211,6 +230,10 @@ class ReadSettings:
         if write:
             self.writeConfig(config, configFile)
 
+        # Discovered ffmpeg capabilities are kept alongside the config so they survive restarts
+        self.capabilitiesfile = os.path.join(os.path.dirname(configFile), 'ffmpeg-capabilities.json')
+        self.speedmodelfile = os.path.join(os.path.dirname(configFile), 'encode-speed.json')
+
         self.readConfig(config)
 
     def readConfig(self, config):
@@ -232,6 +255,37 @@ class ReadSettings:
         self.detailedprogress = config.getboolean(section, 'detailed-progress')
         self.attachmentcodec = config.getList(section, 'attachment-codec')
         self.multibitrate = config.getboolean(section, 'multi-bitrate')
+        self.laddermode = config.get(section, 'ladder-mode').lower().strip()
+        if self.laddermode not in ['sequential', 'single-decode', 'parallel']:
+            self.log.error("Invalid ladder-mode %s, defaulting to sequential." % self.laddermode)
+            self.laddermode = 'sequential'
+        self.maxprocesses = config.getInt(section, 'max-processes')
+        self.ladderminsavings = config.getfloat(section, 'ladder-min-savings')
+        self.chunkedencoding = config.getboolean(section, 'chunked-encoding')
+        self.copycompliant = config.getboolean(section, 'copy-compliant-video')
+        self.ladderoutput = config.get(section, 'ladder-output').lower().strip()
+        if self.ladderoutput not in ['mp4', 'hls']:
+            self.log.error("Invalid ladder-output %s, defaulting to mp4." % self.ladderoutput)
+            self.ladderoutput = 'mp4'
+        self.dashmanifest = config.getboolean(section, 'dash-manifest')
+        self.pertitle = config.getboolean(section, 'per-title-bitrate')
+        self.analysissamples = config.getInt(section, 'analysis-samples')
+        self.probecache = config.getPath(section, 'probe-cache', vars=os.environ)
+        self.probeworkers = max(1, config.getInt(section, 'probe-workers'))
+        self.trickplay = config.get(section, 'trickplay').lower().strip()
+        if self.trickplay and self.trickplay not in ['vtt', 'bif']:
+            self.log.error("Invalid trickplay format %s, trickplay disabled." % self.trickplay)
+            self.trickplay = ''
+        self.trickplayinterval = max(1, config.getInt(section, 'trickplay-interval'))
+        self.trickplaywidth = config.getInt(section, 'trickplay-width')
+        self.autocrop = config.getboolean(section, 'auto-crop')
+        # A daily budget in hours of source encoded per day is the same as a realtime factor of hours / 24
+        self.encoderealtime = config.getfloat(section, 'encode-realtime')
+        encodedailyhours = config.getfloat(section, 'encode-daily-hours')
+        if encodedailyhours > 0:
+            self.encoderealtime = encodedailyhours / 24.0
+        self.encodepresets = config.getList(section, 'encode-presets')
+        self.encodetune = config.get(section, 'encode-tune').lower().strip()
     
         # Permissions
         section = "Permissions"
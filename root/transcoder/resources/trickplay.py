@@ -0,0 +1,116 @@
+import os
+import math
+import struct
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from converter import FFMpegError
+
+
+# Builds trickplay previews of an output from keyframes grabbed at a fixed interval, either tiled into sprite sheets indexed by WebVTT or packed into a Roku BIF file
+class Trickplay:
+    formats = ['vtt', 'bif']
+    columns = 10
+    rows = 10
+    quality = 5
+
+    # Seek points grabbed by a single ffmpeg process, and how many of those processes run at once
+    batchSize = 10
+    workers = 4
+
+    bifMagic = b'\x89BIF\r\n\x1a\n'
+
+    def __init__(self, converter, format='vtt', interval=10, width=320, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.converter = converter
+        self.format = format
+        self.interval = interval
+        self.width = width
+
+    def times(self, duration):
+        return [i * self.interval for i in range(int(math.ceil(duration / self.interval)))]
+
+    # Thumbnail size keeping the aspect ratio of the video, ffmpeg needs even dimensions
+    def size(self, info):
+        width = min(self.width, info.video.video_width)
+        height = int(round(width * info.video.video_height / info.video.video_width / 2.0)) * 2
+        return width - width % 2, height
+
+    # Grab a keyframe at every time point as frame_00000.jpg onwards, running batches of seek points in parallel
+    def grabFrames(self, inputFile, times, frameDir, size):
+        thumbs = [(t, os.path.join(frameDir, 'frame_%05d.jpg' % i), '%dx%d' % size, self.quality) for i, t in enumerate(times)]
+        batches = [thumbs[i:i + self.batchSize] for i in range(0, len(thumbs), self.batchSize)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(self.converter.thumbnails, inputFile, batch, True) for batch in batches]:
+                future.result()
+
+    def writeSprites(self, frameDir, count, size, outputDir, name):
+        width, height = size
+        perSheet = self.columns * self.rows
+        cues = ['WEBVTT', '']
+        for sheet in range(int(math.ceil(count / float(perSheet)))):
+            sprite = '%s_%05d.jpg' % (name, sheet)
+            self.converter.tile(os.path.join(frameDir, 'frame_%05d.jpg'), sheet * perSheet, self.columns, self.rows, os.path.join(outputDir, sprite), self.quality)
+            for i in range(sheet * perSheet, min(count, (sheet + 1) * perSheet)):
+                x = (i % perSheet) % self.columns * width
+                y = (i % perSheet) // self.columns * height
+                cues.append('%s --> %s' % (self.timestamp(i * self.interval), self.timestamp((i + 1) * self.interval)))
+                cues.append('%s#xywh=%d,%d,%d,%d' % (sprite, x, y, width, height))
+                cues.append('')
+
+        vtt = os.path.join(outputDir, name + '.vtt')
+        with open(vtt, 'w') as f:
+            f.write('\n'.join(cues))
+        return vtt
+
+    @staticmethod
+    def timestamp(seconds):
+        return '%02d:%02d:%02d.000' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    # BIF layout: magic, version, image count, timestamp multiplier in ms, padding to 64 bytes, then an index of (timestamp, offset) pairs ending in 0xffffffff
+    def writeBif(self, frameDir, count, bif):
+        frames = [os.path.join(frameDir, 'frame_%05d.jpg' % i) for i in range(count)]
+        offset = 64 + 8 * (count + 1)
+        index = b''
+        for i, frame in enumerate(frames):
+            index += struct.pack('<II', i, offset)
+            offset += os.path.getsize(frame)
+        index += struct.pack('<II', 0xffffffff, offset)
+
+        with open(bif, 'wb') as f:
+            f.write(self.bifMagic + struct.pack('<III', 0, count, int(self.interval * 1000)) + b'\0' * 44)
+            f.write(index)
+            for frame in frames:
+                with open(frame, 'rb') as image:
+                    shutil.copyfileobj(image, f)
+        return bif
+
+    # Build the trickplay for a file next to it, returning the BIF file or the directory of sprite sheets and their index, None if it failed
+    def generate(self, inputFile, info, outputDir=None):
+        if not info or not info.video or not info.format.duration:
+            return None
+
+        outputDir = outputDir or os.path.dirname(inputFile)
+        name = os.path.splitext(os.path.basename(inputFile))[0]
+        size = self.size(info)
+        times = self.times(info.format.duration)
+
+        frameDir = tempfile.mkdtemp(prefix='mmt-trickplay-')
+        try:
+            self.grabFrames(inputFile, times, frameDir, size)
+            if self.format == 'bif':
+                output = self.writeBif(frameDir, len(times), os.path.join(outputDir, '%s-%d-%d.bif' % (name, size[0], self.interval)))
+            else:
+                output = os.path.join(outputDir, name + '.trickplay')
+                if not os.path.isdir(output):
+                    os.makedirs(output)
+                self.writeSprites(frameDir, len(times), size, output, name)
+        except (FFMpegError, IOError, OSError):
+            self.log.exception("Unable to generate trickplay for %s." % inputFile)
+            return None
+        finally:
+            shutil.rmtree(frameDir, ignore_errors=True)
+
+        self.log.info("Trickplay with %d thumbnails written to %s." % (len(times), output))
+        return output